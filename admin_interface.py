@@ -10,12 +10,14 @@ from utils import (
     process_uploaded_files,
     get_all_clusters,
     upload_to_drive_and_send_email,
+    approve_requests_by_cluster,
     rename_cluster,
     delete_cluster
 )
 from shared_constants import DATASET_FOLDER, RESULTS_FOLDER
 from crud_operations import find_cluster_by_image, show_cluster_images
-from database import Database
+from database import Database, PAGE_SIZE
+from cluster_health import load_health, run_health_check
 from datetime import datetime
 from PIL import Image
 import time
@@ -52,6 +54,44 @@ def show_stats_interface():
         st.metric("Total Images", stats.get('total_images', 0))
     with col3:
         st.metric("Storage Used (MB)", f"{stats.get('storage_used', 0):.2f}")
+    
+    show_cluster_health()
+
+def show_cluster_health():
+    st.subheader("Cluster Health")
+    
+    if st.button("Recompute Cluster Health"):
+        with st.spinner("Measuring cluster dispersion..."):
+            run_health_check(RESULTS_FOLDER, st.session_state.get('encodings_manager'))
+    
+    # Read from the last persisted run; nothing is recomputed on page load
+    health = load_health(RESULTS_FOLDER)
+    if not health:
+        st.info("Cluster health has not been computed yet")
+        return
+    
+    st.caption(f"Computed {datetime.fromtimestamp(health['computed_at']).strftime('%Y-%m-%d %H:%M')}")
+    flagged = [entry for entry in health['clusters'] if entry['flagged']]
+    if not flagged:
+        st.success("No clusters look like they hold more than one person")
+        return
+    
+    st.warning(f"{len(flagged)} clusters may hold more than one person")
+    for entry in flagged:
+        with st.expander(f"{entry['cluster_id']} ({entry['size']} faces)"):
+            st.text(f"Flagged by: {', '.join(entry.get('flagged_by', []))}")
+            st.text(f"Pairs further apart than tolerance: {entry['spread']:.0%}")
+            st.text(f"Bimodality: {entry['bimodality']:.2f}")
+            if 'proposed_split_images' not in entry:
+                st.text("No split with enough faces on both sides")
+                continue
+            st.text(f"Closest faces across the split: {entry['split_gap']:.3f}")
+            st.write("Proposed split:")
+            cols = st.columns(2)
+            for col, images in zip(cols, entry['proposed_split_images']):
+                with col:
+                    st.write(f"{len(images)} images")
+                    st.text("\n".join(images))
 
 def show_processing_interface():
     st.header("Process New Images")
@@ -180,45 +220,71 @@ def show_user_requests():
     with tab2:
         show_all_requests()
 
+def request_page(key, total):
+    """Page selector for a request listing; returns the offset of the chosen page"""
+    pages = max(1, -(-total // PAGE_SIZE))
+    if pages == 1:
+        return 0
+    page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=key)
+    st.caption(f"{total} requests, page {page} of {pages}")
+    return (page - 1) * PAGE_SIZE
+
+def show_bulk_approval():
+    clusters = db.get_pending_clusters()
+    if not clusters:
+        return
+    total = sum(cluster['count'] for cluster in clusters)
+    st.caption(f"{total} pending requests for {len(clusters)} clusters")
+    if st.button(f"Approve all ({len(clusters)} uploads)", key="approve_all"):
+        if handle_bulk_approval():
+            st.experimental_rerun()
+
 def show_pending_requests():
-    pending_requests = db.get_pending_requests()
+    show_bulk_approval()
+    offset = request_page("pending_page", db.count_requests('pending'))
+    pending_requests = db.get_pending_requests(limit=PAGE_SIZE, offset=offset)
     if not pending_requests:
         st.info("No pending requests")
         return
         
     for request in pending_requests:
-        with st.expander(f"Request: {request[0]}"):
+        with st.expander(f"Request: {request['request_id']}"):
             cols = st.columns([2, 1])
             
             with cols[0]:
-                st.text(f"Email: {request[1]}")
-                st.text(f"Cluster ID: {request[2]}")
-                st.text(f"Submitted: {request[4]}")
+                st.text(f"Email: {request['email']}")
+                st.text(f"Cluster ID: {request['cluster_id']}")
+                st.text(f"Submitted: {request['submitted_at']}")
                 
-                cluster_path = Path(RESULTS_FOLDER) / str(request[2])
+                cluster_path = Path(RESULTS_FOLDER) / str(request['cluster_id'])
                 if cluster_path.exists():
                     show_cluster_images(cluster_path)
             
             with cols[1]:
-                if st.button("Approve", key=f"approve_{request[0]}"):
-                    if handle_request_approval(request[0]):
+                if st.button("Approve", key=f"approve_{request['request_id']}"):
+                    if handle_request_approval(request['request_id']):
                         st.experimental_rerun()
-                if st.button("Reject", key=f"reject_{request[0]}"):
-                    db.update_request_status(request[0], 'rejected')
+                if st.button("Reject", key=f"reject_{request['request_id']}"):
+                    db.update_request_status(request['request_id'], 'rejected')
                     st.experimental_rerun()
 
 def show_all_requests():
-    all_requests = db.get_all_requests()
+    offset = request_page("all_page", db.count_requests())
+    all_requests = db.get_all_requests(limit=PAGE_SIZE, offset=offset)
     if not all_requests:
         st.info("No requests found")
         return
         
     for request in all_requests:
-        with st.expander(f"Request: {request[0]} ({request[5]})"):
-            st.text(f"Email: {request[1]}")
-            st.text(f"Cluster ID: {request[2]}")
-            st.text(f"Submitted: {request[4]}")
-            st.text(f"Status: {request[5]}")
+        with st.expander(f"Request: {request['request_id']} ({request['status']})"):
+            st.text(f"Email: {request['email']}")
+            st.text(f"Cluster ID: {request['cluster_id']}")
+            st.text(f"Submitted: {request['submitted_at']}")
+            st.text(f"Status: {request['status']}")
+            notification = db.get_notification(request['request_id'])
+            if notification:
+                error = f" ({notification['last_error']})" if notification['last_error'] else ""
+                st.text(f"Email: {notification['status']} after {notification['attempts']} attempt(s){error}")
 
 def handle_request_approval(request_id):
     request = db.get_request_by_id(request_id)
@@ -226,17 +292,45 @@ def handle_request_approval(request_id):
         st.error("Request not found")
         return False
         
-    email = request[1]
-    cluster_id = request[2]
+    email = request['email']
+    cluster_id = request['cluster_id']
     
-    success, message = upload_to_drive_and_send_email(email, cluster_id)
+    progress_bar = st.progress(0.0)
+    status_text = st.empty()
+    
+    def show_progress(done, total, result):
+        progress_bar.progress(done / total)
+        outcome = "uploaded" if result['ok'] else f"failed ({result['error']})"
+        status_text.text(f"{done}/{total}: {result['name']} {outcome}")
+    
+    success, message = upload_to_drive_and_send_email(email, cluster_id, show_progress, request_id)
     if success:
         db.update_request_status(request_id, 'approved')
-        st.success("Request approved and email sent successfully!")
+        st.success("Request approved and email queued!")
         return True
     else:
         st.error(f"Failed to process request: {message}")
         return False
 
+def handle_bulk_approval():
+    """Approve every pending request with one upload per cluster"""
+    pending_requests = db.get_pending_requests()
+    progress_bar = st.progress(0.0)
+    status_text = st.empty()
+    
+    def show_progress(done, total, cluster_id):
+        progress_bar.progress(done / total)
+        status_text.text(f"{done}/{total} clusters delivered ({cluster_id})")
+    
+    approved, failures = approve_requests_by_cluster(pending_requests, show_progress)
+    db.update_request_statuses(approved, 'approved')
+    
+    if approved:
+        st.success(f"Approved {len(approved)} requests")
+    for request_id, message in failures:
+        st.error(f"{request_id}: {message}")
+    return not failures
+
+
 if __name__ == "__main__":
-    admin_interface()
\ No newline at end of file
+    admin_interface()
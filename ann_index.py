@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import numpy as np
+
+ANN_HEADER_FILE = 'ann_index.json'
+ANN_CENTROIDS_FILE = 'ann_centroids.npy'
+ANN_ASSIGN_FILE = 'ann_assign.npy'
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 100000
+BLOCK_ROWS = 65536
+
+
+def _generation_file(name, generation):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{generation}{ext}"
+
+
+def _write_atomic(path, write):
+    # Temp file plus rename, so a crash never leaves a truncated file under path
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def default_nlist(count):
+    """About 4 * sqrt(N) coarse lists, so a probe scans roughly sqrt(N) / 4 rows"""
+    return int(min(65536, max(1, 4 * np.sqrt(count))))
+
+
+def nearest_centroids(vectors, centroids, k=1):
+    """Indexes of the k nearest centroids for each vector, computed in blocks"""
+    vectors = np.atleast_2d(vectors)
+    c_sq = np.einsum('ij,ij->i', centroids, centroids)
+    k = min(k, len(centroids))
+    result = np.empty((len(vectors), k), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float64)
+        # |v|^2 is the same for every centroid, so it does not change the order
+        sq = c_sq - 2 * (block @ centroids.T)
+        if k == 1:
+            result[start:start + len(block), 0] = np.argmin(sq, axis=1)
+        else:
+            nearest = np.argpartition(sq, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(sq, nearest, axis=1), axis=1)
+            result[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+    return result
+
+
+def kmeans(matrix, nlist, iterations=KMEANS_ITERATIONS, sample_size=KMEANS_SAMPLE, seed=0):
+    """Lloyd's k-means on a random sample of the rows; returns (nlist, dim) centroids"""
+    rng = np.random.default_rng(seed)
+    count = len(matrix)
+    nlist = min(nlist, count)
+    sample_rows = np.sort(rng.choice(count, size=min(count, max(sample_size, nlist)), replace=False))
+    sample = np.asarray(matrix[sample_rows], dtype=np.float64)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = nearest_centroids(sample, centroids)[:, 0]
+        sizes = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        filled = sizes > 0
+        centroids[filled] = sums[filled] / sizes[filled, None]
+        # Reseed empty lists from random sample rows
+        empty = np.nonzero(~filled)[0]
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), size=len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index over the rows of the encodings matrix.
+
+    Rows are bucketed by their nearest k-means centroid. A query scans only
+    the rows in its nprobe nearest buckets, so its cost grows with about
+    sqrt(N) instead of N. The index stores row numbers only; distances are
+    computed against the EncodingsManager matrix.
+    """
+
+    def __init__(self, nprobe=DEFAULT_NPROBE):
+        self.nprobe = nprobe
+        self.centroids = None
+        self.trained_count = 0
+        self._assign = np.empty(0, dtype=np.int32)
+        self._count = 0
+        self._order = np.empty(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._tails = []
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def nlist(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def train(self, matrix, nlist=None):
+        """Cluster the rows of matrix into nlist buckets and index all of them"""
+        nlist = nlist or default_nlist(len(matrix))
+        self.centroids = kmeans(matrix, nlist)
+        self.trained_count = len(matrix)
+        self._set_assign(nearest_centroids(matrix, self.centroids)[:, 0].astype(np.int32))
+
+    def _set_assign(self, assign):
+        self._assign = assign
+        self._count = len(assign)
+        self._order = np.argsort(assign, kind='stable')
+        self._offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist))))
+        self._tails = [[] for _ in range(self.nlist)]
+
+    def add(self, rows, vectors):
+        """Index new rows; rows must continue the existing numbering"""
+        rows = np.atleast_1d(rows)
+        if len(rows) == 0:
+            return
+        lists = nearest_centroids(vectors, self.centroids)[:, 0].astype(np.int32)
+        if len(self._assign) < self._count + len(rows):
+            assign = np.empty(max(self._count + len(rows), len(self._assign) * 2), dtype=np.int32)
+            assign[:self._count] = self._assign[:self._count]
+            self._assign = assign
+        self._assign[self._count:self._count + len(rows)] = lists
+        self._count += len(rows)
+        for row, list_id in zip(rows, lists):
+            self._tails[list_id].append(int(row))
+
+    def candidates(self, query, nprobe=None):
+        """Rows in the nprobe buckets nearest to query"""
+        nprobe = nprobe or self.nprobe
+        probes = nearest_centroids(query, self.centroids, nprobe)[0]
+        parts = [self._order[self._offsets[p]:self._offsets[p + 1]] for p in probes]
+        parts += [np.asarray(self._tails[p], dtype=np.int64) for p in probes if self._tails[p]]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def save(self, store_path, generation):
+        """Persist the centroids and per-row bucket next to the encodings store.
+
+        Like the store itself, the arrays go to files named after the
+        snapshot generation and the header naming them is swapped in last.
+        """
+        files = {
+            'centroids': _generation_file(ANN_CENTROIDS_FILE, generation),
+            'assign': _generation_file(ANN_ASSIGN_FILE, generation)
+        }
+        _write_atomic(os.path.join(store_path, files['centroids']), lambda f: np.save(f, self.centroids))
+        _write_atomic(os.path.join(store_path, files['assign']), lambda f: np.save(f, self._assign[:self._count]))
+        header = {
+            'nlist': self.nlist,
+            'count': self._count,
+            'trained_count': self.trained_count,
+            'generation': int(generation),
+            'files': files
+        }
+        _write_atomic(os.path.join(store_path, ANN_HEADER_FILE), lambda f: f.write(json.dumps(header).encode('utf-8')))
+
+        prefixes = tuple(f"{os.path.splitext(name)[0]}." for name in (ANN_CENTROIDS_FILE, ANN_ASSIGN_FILE))
+        for name in os.listdir(store_path):
+            if name.startswith(prefixes) and name not in files.values():
+                os.remove(os.path.join(store_path, name))
+
+    @classmethod
+    def load(cls, store_path, nprobe=DEFAULT_NPROBE, generation=None):
+        """Load a persisted index, or return None if there is none.
+
+        An index saved with another snapshot generation than the store's is
+        stale (it describes other rows), so None is returned for it too.
+        """
+        header_path = os.path.join(store_path, ANN_HEADER_FILE)
+        if not os.path.exists(header_path):
+            return None
+        try:
+            with open(header_path, 'r') as f:
+                header = json.load(f)
+            if generation is not None and header.get('generation') != generation:
+                print(f"ANN index was saved with snapshot {header.get('generation')}, not {generation}; rebuilding")
+                return None
+            files = header.get('files', {})
+            index = cls(nprobe)
+            index.centroids = np.load(os.path.join(store_path, files.get('centroids', ANN_CENTROIDS_FILE)))
+            index.trained_count = header['trained_count']
+            assign = np.load(os.path.join(store_path, files.get('assign', ANN_ASSIGN_FILE)))
+            if len(assign) != header['count'] or len(index.centroids) != header['nlist']:
+                raise ValueError("index files are inconsistent with their header")
+            index._set_assign(assign.astype(np.int32))
+            return index
+        except Exception as e:
+            print(f"Error loading ANN index: {e}")
+            return None
+
+
+def recall_report(encodings_manager, sample=1000, nprobes=(1, 2, 4, 8, 16, 32), tolerance=0.6, seed=0):
+    """Compare IVF best-match results with exact search on stored encodings.
+
+    Each sampled row is used as a query with itself left out. Recall is the
+    fraction of queries whose approximate result (cluster, or no match)
+    equals the exact one. Returns a list of dicts, one per nprobe.
+    """
+    index = encodings_manager.ann_index
+    if index is None or not index.trained:
+        print("No ANN index has been built")
+        return []
+
+    matrix = encodings_manager.matrix
+    labels = encodings_manager.labels
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(matrix), size=min(sample, len(matrix)), replace=False)
+
+    exact = {}
+    start = time.perf_counter()
+    for row in queries:
+        distances = encodings_manager.face_distances(matrix[row])
+        distances[row] = np.inf
+        best = int(np.argmin(distances))
+        exact[row] = labels[best] if distances[best] < tolerance else -1
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobes:
+        hits, scanned = 0, 0
+        start = time.perf_counter()
+        for row in queries:
+            rows = index.candidates(matrix[row], nprobe)
+            rows = rows[rows != row]
+            scanned += len(rows)
+            found = -1
+            if len(rows):
+                distances = encodings_manager._row_distances(rows, matrix[row])
+                best = int(np.argmin(distances))
+                if distances[best] < tolerance:
+                    found = labels[rows[best]]
+            hits += int(found == exact[row])
+        report.append({
+            'nprobe': nprobe,
+            'recall': hits / len(queries),
+            'scanned_fraction': scanned / (len(queries) * len(matrix)),
+            'ms_per_query': (time.perf_counter() - start) * 1000 / len(queries),
+            'exact_ms_per_query': exact_ms
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    from shared_constants import RESULTS_FOLDER
+    from encodings_manager import EncodingsManager
+
+    # python ann_index.py [results_folder]: build the index if needed and print recall per nprobe
+    manager = EncodingsManager(sys.argv[1] if len(sys.argv) > 1 else RESULTS_FOLDER, ann_min_rows=1)
+    manager.save_encodings()
+    print(f"{manager.matrix.shape[0]} encodings, {manager.ann_index.nlist} lists")
+    print("nprobe  recall  scanned  ms/query  exact ms/query")
+    for entry in recall_report(manager):
+        print(f"{entry['nprobe']:>6}  {entry['recall']:.3f}  {entry['scanned_fraction']:7.2%}  "
+              f"{entry['ms_per_query']:8.3f}  {entry['exact_ms_per_query']:14.3f}")
+    manager.close()
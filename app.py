@@ -1,6 +1,7 @@
 from utils import (upload_to_drive_and_send_email, show_cluster_preview, process_uploaded_files, 
                   get_all_clusters, delete_cluster,
-                  delete_image_from_cluster, move_image_to_cluster, process_file, email_is_valid, send_cluster_notification)
+                  delete_image_from_cluster, move_image_to_cluster, process_file, email_is_valid, send_cluster_notification,
+                  start_notification_sender)
 from database import Database
 import streamlit as st
 import face_recognition
@@ -13,6 +14,7 @@ from shared_constants import RESULTS_FOLDER, DATASET_FOLDER
 from config import ADMIN_PASSWORD
 from admin_interface import admin_interface
 from datetime import datetime
+import uuid
 
 # Must be first Streamlit command
 st.set_page_config(
@@ -27,6 +29,8 @@ if 'db' not in st.session_state:
     st.session_state['db'] = Database()
 
 def init_session_state():
+    # Delivers emails queued by approvals, including ones left from earlier runs
+    start_notification_sender()
     if 'encodings_manager' not in st.session_state:
         st.session_state.encodings_manager = EncodingsManager(RESULTS_FOLDER)
     if 'pending_requests' not in st.session_state:
@@ -74,55 +78,57 @@ def user_interface():
             show_request_status(request_id, email_check)
 
 def handle_upload(uploaded_file, email):
+    """Queue the upload for the worker and hand back its request ID straight away"""
     try:
-        # Save uploaded file
-        temp_dir = Path("temp_uploads")
-        temp_dir.mkdir(exist_ok=True)
-        file_path = temp_dir / uploaded_file.name
+        request_id = f"REQ_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        # Kept until the worker has matched it
+        queue_dir = Path("temp_uploads") / "queue"
+        queue_dir.mkdir(parents=True, exist_ok=True)
+        file_path = queue_dir / f"{request_id}{Path(uploaded_file.name).suffix.lower()}"
         
         with open(file_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
         
-        # Process image
-        cluster_id = process_file(str(file_path), st.session_state.encodings_manager)
-        
-        if cluster_id:
-            request_id = f"REQ_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            st.session_state.db.create_request(
-                request_id=request_id,
-                email=email,
-                cluster_id=cluster_id,
-                image_path=str(file_path)
-            )
-            
-            st.success(f"""
-            ✅ Photo uploaded successfully!
-            Your Request ID: {request_id}
-            Please save this ID to check your request status.
-            We'll email you when matches are found.
-            """)
-        else:
-            st.error("No face detected in the uploaded image. Please try another photo.")
+        st.session_state.db.enqueue_job(request_id, email, str(file_path))
+        st.success(f"""
+        ✅ Photo uploaded successfully!
+        Your Request ID: {request_id}
+        Please save this ID to check your request status.
+        We'll email you when matches are found.
+        """)
             
     except Exception as e:
         st.error(f"Error processing request: {str(e)}")
-    finally:
         if 'file_path' in locals() and file_path.exists():
             file_path.unlink()
 
 def show_request_status(request_id, email):
     try:
-        request = st.session_state.db.get_request(request_id, email)
+        db = st.session_state.db
+        request = db.get_request(request_id, email)
         if request:
-            status = request[5]  # Assuming status is at index 5
+            status = request['status']
             if status == 'pending':
-                st.info("Your request is still being processed. We'll email you when complete.")
+                st.info("A match was found and is waiting for review. We'll email you when it is approved.")
             elif status == 'approved':
-                st.success("Your request was approved! Check your email for the matches.")
+                notification = db.get_notification(request_id)
+                if notification and notification['status'] != 'sent':
+                    st.success("Your request was approved! The email with your matches is on its way.")
+                else:
+                    st.success("Your request was approved! Check your email for the matches.")
             elif status == 'rejected':
                 st.error("Your request was rejected. Please try uploading a clearer photo.")
-        else:
+            return
+        
+        job = db.get_job(request_id, email)
+        if not job:
             st.error("Request not found. Please check your Request ID and email.")
+        elif job['status'] == 'queued':
+            st.info(f"Your photo is queued for processing ({db.queue_position(job)} ahead of it).")
+        elif job['status'] == 'processing':
+            st.info("Your photo is being processed.")
+        elif job['status'] == 'failed':
+            st.error(f"We couldn't process your photo: {job['error']}. Please try another photo.")
     except Exception as e:
         st.error(f"Error checking status: {str(e)}")
 
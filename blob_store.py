@@ -0,0 +1,90 @@
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+from shutil import copyfile, copymode
+from shared_constants import RESULTS_FOLDER
+
+BLOB_FOLDER = 'blobs'
+
+
+def hash_file(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def blob_path(content_hash, suffix, results_path=RESULTS_FOLDER):
+    """results/blobs/<first two hex digits>/<hash><suffix>"""
+    return Path(results_path) / BLOB_FOLDER / content_hash[:2] / f"{content_hash}{suffix.lower()}"
+
+
+def put_blob(filepath, content_hash=None, results_path=RESULTS_FOLDER):
+    """Store one copy of filepath under its content hash; returns the blob path.
+
+    Content already in the store is not copied again. content_hash can be
+    passed when the caller already has the SHA-256 of the file (e.g. from the
+    encoding cache).
+    """
+    content_hash = content_hash or hash_file(filepath)
+    path = blob_path(content_hash, Path(filepath).suffix, results_path)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Copy under a unique temp name so a crash never leaves a truncated
+        # blob and concurrent writers of the same content do not collide
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=path.parent)
+        os.close(fd)
+        try:
+            copyfile(filepath, tmp_path)
+            # mkstemp creates the file owner-only
+            copymode(filepath, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            # Another writer stored the same content first
+            if not path.exists():
+                raise
+    return path
+
+
+def link_blob(blob, dest_path):
+    """Make dest_path a reference to blob: a hard link, or a copy where links are not supported"""
+    dest_path = Path(dest_path)
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    if dest_path.exists():
+        if os.path.samefile(blob, dest_path):
+            return dest_path
+        dest_path.unlink()
+    try:
+        os.link(blob, dest_path)
+    except OSError:
+        copyfile(blob, dest_path)
+    return dest_path
+
+
+def collect_garbage(results_path=RESULTS_FOLDER):
+    """Delete blobs no cluster links to any more; returns the number removed.
+
+    Membership is by hard link, so a blob whose link count dropped to one is
+    referenced by nothing but the store itself.
+    """
+    removed = 0
+    for path in (Path(results_path) / BLOB_FOLDER).glob('*/*'):
+        try:
+            if path.suffix == '.tmp' or path.stat().st_nlink > 1:
+                continue
+            path.unlink()
+            removed += 1
+        except OSError as e:
+            print(f"Error removing blob {path}: {e}")
+    return removed
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python blob_store.py [results_folder]: remove unreferenced blobs
+    print(f"Removed {collect_garbage(sys.argv[1] if len(sys.argv) > 1 else RESULTS_FOLDER)} unreferenced blobs")
@@ -0,0 +1,260 @@
+import os
+from pathlib import Path
+from shared_constants import RESULTS_FOLDER
+from database import DB_PATH, connect
+from blob_store import BLOB_FOLDER
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class Catalog:
+    """Cluster, image, face and membership tables kept next to the requests table.
+
+    Ingestion and the cluster management functions update it as they change
+    the results folder, so listings and stats are indexed queries instead of
+    directory walks. Per-cluster counts are maintained by triggers. It shares
+    the per-thread connections of the database module.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = str(db_path)
+        self.init_db()
+
+    def init_db(self):
+        with connect(self.db_path) as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS clusters (
+                    cluster_id TEXT PRIMARY KEY,
+                    image_count INTEGER NOT NULL DEFAULT 0,
+                    face_count INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS images (
+                    content_hash TEXT PRIMARY KEY,
+                    size_bytes INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cluster_images (
+                    cluster_id TEXT NOT NULL,
+                    image_name TEXT NOT NULL,
+                    content_hash TEXT,
+                    PRIMARY KEY (cluster_id, image_name)
+                );
+                CREATE INDEX IF NOT EXISTS idx_cluster_images_hash ON cluster_images (content_hash);
+                CREATE TABLE IF NOT EXISTS faces (
+                    face_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    cluster_id TEXT NOT NULL,
+                    image_name TEXT NOT NULL,
+                    top INTEGER, right INTEGER, bottom INTEGER, left INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS idx_faces_cluster ON faces (cluster_id);
+                CREATE INDEX IF NOT EXISTS idx_faces_image ON faces (image_name);
+
+                CREATE TRIGGER IF NOT EXISTS cluster_images_insert AFTER INSERT ON cluster_images BEGIN
+                    INSERT OR IGNORE INTO clusters (cluster_id) VALUES (NEW.cluster_id);
+                    UPDATE clusters SET image_count = image_count + 1 WHERE cluster_id = NEW.cluster_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS cluster_images_delete AFTER DELETE ON cluster_images BEGIN
+                    UPDATE clusters SET image_count = image_count - 1 WHERE cluster_id = OLD.cluster_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS cluster_images_move AFTER UPDATE OF cluster_id ON cluster_images BEGIN
+                    INSERT OR IGNORE INTO clusters (cluster_id) VALUES (NEW.cluster_id);
+                    UPDATE clusters SET image_count = image_count - 1 WHERE cluster_id = OLD.cluster_id;
+                    UPDATE clusters SET image_count = image_count + 1 WHERE cluster_id = NEW.cluster_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS faces_insert AFTER INSERT ON faces BEGIN
+                    INSERT OR IGNORE INTO clusters (cluster_id) VALUES (NEW.cluster_id);
+                    UPDATE clusters SET face_count = face_count + 1 WHERE cluster_id = NEW.cluster_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS faces_delete AFTER DELETE ON faces BEGIN
+                    UPDATE clusters SET face_count = face_count - 1 WHERE cluster_id = OLD.cluster_id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS faces_move AFTER UPDATE OF cluster_id ON faces BEGIN
+                    INSERT OR IGNORE INTO clusters (cluster_id) VALUES (NEW.cluster_id);
+                    UPDATE clusters SET face_count = face_count - 1 WHERE cluster_id = OLD.cluster_id;
+                    UPDATE clusters SET face_count = face_count + 1 WHERE cluster_id = NEW.cluster_id;
+                END;
+            ''')
+
+    def is_empty(self):
+        with connect(self.db_path) as conn:
+            return conn.execute('SELECT 1 FROM clusters LIMIT 1').fetchone() is None
+
+    def record_image(self, image_name, content_hash, size_bytes, cluster_ids, faces=()):
+        """Record an ingested image, its cluster memberships and its (cluster_id, box) faces in one transaction"""
+        try:
+            with connect(self.db_path) as conn:
+                if content_hash:
+                    conn.execute(
+                        'INSERT OR IGNORE INTO images (content_hash, size_bytes) VALUES (?, ?)',
+                        (content_hash, size_bytes)
+                    )
+                for cluster_id in dict.fromkeys(cluster_ids):
+                    conn.execute('DELETE FROM cluster_images WHERE cluster_id = ? AND image_name = ?',
+                                 (cluster_id, image_name))
+                    conn.execute(
+                        'INSERT INTO cluster_images (cluster_id, image_name, content_hash) VALUES (?, ?, ?)',
+                        (cluster_id, image_name, content_hash)
+                    )
+                faces = list(faces)
+                # Re-ingesting an image replaces its faces instead of adding them again
+                for cluster_id in dict.fromkeys(cluster_id for cluster_id, _ in faces):
+                    conn.execute('DELETE FROM faces WHERE cluster_id = ? AND image_name = ?', (cluster_id, image_name))
+                conn.executemany(
+                    'INSERT INTO faces (cluster_id, image_name, top, right, bottom, left) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(cluster_id, image_name, *[int(v) for v in box]) for cluster_id, box in faces]
+                )
+            return True
+        except Exception as e:
+            print(f"Error updating catalog: {e}")
+            return False
+
+    def move_image(self, source_cluster, target_cluster, image_name):
+        with connect(self.db_path) as conn:
+            conn.execute('DELETE FROM cluster_images WHERE cluster_id = ? AND image_name = ?',
+                         (target_cluster, image_name))
+            conn.execute(
+                'UPDATE cluster_images SET cluster_id = ? WHERE cluster_id = ? AND image_name = ?',
+                (target_cluster, source_cluster, image_name)
+            )
+            conn.execute(
+                'UPDATE faces SET cluster_id = ? WHERE cluster_id = ? AND image_name = ?',
+                (target_cluster, source_cluster, image_name)
+            )
+
+    def remove_image(self, cluster_id, image_name):
+        with connect(self.db_path) as conn:
+            conn.execute('DELETE FROM cluster_images WHERE cluster_id = ? AND image_name = ?',
+                         (cluster_id, image_name))
+            conn.execute('DELETE FROM faces WHERE cluster_id = ? AND image_name = ?', (cluster_id, image_name))
+
+    def delete_cluster(self, cluster_id):
+        with connect(self.db_path) as conn:
+            conn.execute('DELETE FROM cluster_images WHERE cluster_id = ?', (cluster_id,))
+            conn.execute('DELETE FROM faces WHERE cluster_id = ?', (cluster_id,))
+            conn.execute('DELETE FROM clusters WHERE cluster_id = ?', (cluster_id,))
+            # Images no other cluster holds lose their blob to collect_garbage
+            conn.execute('''
+                DELETE FROM images WHERE content_hash NOT IN
+                    (SELECT content_hash FROM cluster_images WHERE content_hash IS NOT NULL)
+            ''')
+
+    def merge_clusters(self, source_cluster, target_cluster):
+        """Move every membership and face of source_cluster to target_cluster"""
+        with connect(self.db_path) as conn:
+            conn.execute('INSERT OR IGNORE INTO clusters (cluster_id) VALUES (?)', (target_cluster,))
+            # Images already in the target keep their existing membership
+            conn.execute('''
+                DELETE FROM cluster_images WHERE cluster_id = ? AND image_name IN
+                    (SELECT image_name FROM cluster_images WHERE cluster_id = ?)
+            ''', (source_cluster, target_cluster))
+            conn.execute('''
+                INSERT INTO cluster_images (cluster_id, image_name, content_hash)
+                SELECT ?, image_name, content_hash FROM cluster_images WHERE cluster_id = ?
+            ''', (target_cluster, source_cluster))
+            conn.execute('DELETE FROM cluster_images WHERE cluster_id = ?', (source_cluster,))
+            conn.execute('''
+                INSERT INTO faces (cluster_id, image_name, top, right, bottom, left)
+                SELECT ?, image_name, top, right, bottom, left FROM faces WHERE cluster_id = ?
+            ''', (target_cluster, source_cluster))
+            conn.execute('DELETE FROM faces WHERE cluster_id = ?', (source_cluster,))
+            conn.execute('DELETE FROM clusters WHERE cluster_id = ?', (source_cluster,))
+
+    def rename_cluster(self, cluster_id, new_name):
+        self.merge_clusters(cluster_id, new_name)
+
+    def has_cluster(self, cluster_id):
+        with connect(self.db_path) as conn:
+            return conn.execute('SELECT 1 FROM clusters WHERE cluster_id = ?', (cluster_id,)).fetchone() is not None
+
+    def list_clusters(self):
+        """[{'id', 'image_count', 'face_count'}] for clusters with at least one image"""
+        with connect(self.db_path) as conn:
+            rows = conn.execute('''
+                SELECT cluster_id, image_count, face_count FROM clusters
+                WHERE image_count > 0 ORDER BY cluster_id
+            ''').fetchall()
+        return [{'id': row[0], 'image_count': row[1], 'face_count': row[2]} for row in rows]
+
+    def cluster_images(self, cluster_id):
+        with connect(self.db_path) as conn:
+            rows = conn.execute(
+                'SELECT image_name FROM cluster_images WHERE cluster_id = ? ORDER BY image_name',
+                (cluster_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def image_hashes(self, cluster_id):
+        """{image_name: content_hash} for the cluster; the hash is None for images catalogued without one"""
+        with connect(self.db_path) as conn:
+            rows = conn.execute(
+                'SELECT image_name, content_hash FROM cluster_images WHERE cluster_id = ?',
+                (cluster_id,)
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def stats(self):
+        with connect(self.db_path) as conn:
+            clusters, memberships, faces = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(image_count), 0), COALESCE(SUM(face_count), 0) '
+                'FROM clusters WHERE image_count > 0'
+            ).fetchone()
+            # Only images some cluster still holds; rows of blobs that were
+            # garbage collected would otherwise still be counted
+            unique_images, stored_bytes = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM images '
+                'WHERE content_hash IN (SELECT content_hash FROM cluster_images)'
+            ).fetchone()
+        return {
+            'clusters': clusters,
+            'images': memberships,
+            'faces': faces,
+            'unique_images': unique_images,
+            'stored_bytes': stored_bytes
+        }
+
+    def rebuild(self, results_path=RESULTS_FOLDER):
+        """Fill the catalog from the cluster folders; used once for results that predate it"""
+        with connect(self.db_path) as conn:
+            conn.executescript('DELETE FROM cluster_images; DELETE FROM faces; DELETE FROM clusters; DELETE FROM images;')
+            # Cluster images are hard links to their blob, so the inode gives the hash
+            blob_hashes = {}
+            for blob in Path(results_path).glob(f'{BLOB_FOLDER}/*/*'):
+                if blob.suffix != '.tmp':
+                    stat = blob.stat()
+                    blob_hashes[(stat.st_dev, stat.st_ino)] = blob.stem
+                    conn.execute('INSERT OR IGNORE INTO images (content_hash, size_bytes) VALUES (?, ?)',
+                                 (blob.stem, stat.st_size))
+            count = 0
+            for cluster_dir in Path(results_path).glob('cluster_*'):
+                if not cluster_dir.is_dir():
+                    continue
+                conn.execute('INSERT OR IGNORE INTO clusters (cluster_id) VALUES (?)', (cluster_dir.name,))
+                for entry in os.scandir(cluster_dir):
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        stat = entry.stat()
+                        conn.execute(
+                            'INSERT INTO cluster_images (cluster_id, image_name, content_hash) VALUES (?, ?, ?)',
+                            (cluster_dir.name, entry.name, blob_hashes.get((stat.st_dev, stat.st_ino)))
+                        )
+                        count += 1
+        print(f"Catalogued {count} cluster images")
+        return count
+
+
+_catalog = None
+
+
+def get_catalog():
+    """Shared Catalog, filled from the results folder the first time it is empty"""
+    global _catalog
+    if _catalog is None:
+        catalog = Catalog()
+        if catalog.is_empty() and any(Path(RESULTS_FOLDER).glob('cluster_*')):
+            catalog.rebuild(RESULTS_FOLDER)
+        _catalog = catalog
+    return _catalog
+
+
+if __name__ == "__main__":
+    # python catalog.py: rebuild the catalog from the results folder
+    Catalog().rebuild(RESULTS_FOLDER)
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import numpy as np
+from shared_constants import RESULTS_FOLDER
+from cluster_similarity import pairwise_distances
+from encodings_manager import EncodingsManager
+
+HEALTH_FILE = 'cluster_health.json'
+# Share of member pairs further apart than tolerance before a cluster is flagged
+SPREAD_THRESHOLD = 0.2
+# Bimodality coefficient above which pair distances look like two groups (uniform = 5/9)
+BIMODALITY_THRESHOLD = 0.555
+# 'any' flags a cluster when either test fires, 'all' only when both do
+FLAG_RULE = 'any'
+MIN_SPLIT_SIZE = 3
+# Larger clusters are measured on a random sample of their members
+SAMPLE_ROWS = 2000
+BLOCK_ROWS = 65536
+
+
+def centroid_stats(matrix, labels, cluster_count):
+    """Per-cluster size, mean and max distance to the centroid, in blocked passes over all rows"""
+    sizes = np.bincount(labels, minlength=cluster_count)
+    sums = np.zeros((cluster_count, matrix.shape[1]))
+    for start in range(0, len(labels), BLOCK_ROWS):
+        block = slice(start, start + BLOCK_ROWS)
+        np.add.at(sums, labels[block], matrix[block])
+    centroids = sums / np.maximum(sizes, 1)[:, None]
+
+    total = np.zeros(cluster_count)
+    furthest = np.zeros(cluster_count)
+    for start in range(0, len(labels), BLOCK_ROWS):
+        block = slice(start, start + BLOCK_ROWS)
+        distances = np.linalg.norm(matrix[block] - centroids[labels[block]], axis=1)
+        np.add.at(total, labels[block], distances)
+        np.maximum.at(furthest, labels[block], distances)
+    return sizes, total / np.maximum(sizes, 1), furthest
+
+
+def bimodality_coefficient(values):
+    """Sarle's bimodality coefficient; above 5/9 suggests two modes"""
+    n = len(values)
+    if n < 4:
+        return 0.0
+    centered = values - values.mean()
+    variance = (centered ** 2).mean()
+    if variance == 0:
+        return 0.0
+    skew = (centered ** 3).mean() / variance ** 1.5
+    kurtosis = (centered ** 4).mean() / variance ** 2 - 3
+    return float((skew ** 2 + 1) / (kurtosis + 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))))
+
+
+def two_means(points, iterations=20):
+    """Split points in two with k-means seeded by the two furthest-apart points"""
+    distances = pairwise_distances(points, points)
+    a, b = np.unravel_index(np.argmax(distances), distances.shape)
+    assign = distances[a] > distances[b]
+    for _ in range(iterations):
+        if assign.all() or not assign.any():
+            break
+        centers = np.stack((points[~assign].mean(axis=0), points[assign].mean(axis=0)))
+        new_assign = np.argmin(pairwise_distances(points, centers), axis=1).astype(bool)
+        if np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+    return assign, distances
+
+
+def cluster_health(encodings_manager, tolerance=0.6, spread_threshold=SPREAD_THRESHOLD,
+                   bimodality_threshold=BIMODALITY_THRESHOLD, sample_rows=SAMPLE_ROWS, seed=0,
+                   rule=FLAG_RULE):
+    """Dispersion statistics for every cluster, with split proposals for flagged ones.
+
+    A cluster is flagged when its spread or its bimodality exceeds the
+    threshold (both, with rule='all'); 'flagged_by' lists the tests that
+    fired. A flagged cluster gets a 'proposed_split' only when both halves
+    have MIN_SPLIT_SIZE members. Returns a list of dicts sorted with
+    flagged clusters first.
+    """
+    matrix = encodings_manager.matrix
+    # Rows of merged clusters count towards the cluster they were merged into
+    canonical = [encodings_manager.identity.find(cluster_id) for cluster_id in encodings_manager.clusters]
+    clusters = list(dict.fromkeys(canonical))
+    index = {cluster_id: k for k, cluster_id in enumerate(clusters)}
+    remap = np.array([index[cluster_id] for cluster_id in canonical], dtype=np.int64)
+    labels = remap[encodings_manager.labels] if len(canonical) else encodings_manager.labels
+    sizes, mean_radius, max_radius = centroid_stats(matrix, labels, len(clusters))
+    order = np.argsort(labels, kind='stable')
+    members = np.split(order, np.cumsum(sizes)[:-1]) if len(clusters) else []
+    rng = np.random.default_rng(seed)
+
+    report = []
+    for k, cluster_id in enumerate(clusters):
+        entry = {
+            'cluster_id': cluster_id,
+            'size': int(sizes[k]),
+            'mean_radius': float(mean_radius[k]),
+            'max_radius': float(max_radius[k]),
+            'flagged': False,
+            'flagged_by': []
+        }
+        report.append(entry)
+        # Two faces within tolerance of each other can't be dispersed
+        if sizes[k] < 2 * MIN_SPLIT_SIZE or max_radius[k] * 2 <= tolerance:
+            continue
+
+        rows = members[k]
+        if len(rows) > sample_rows:
+            rows = np.sort(rng.choice(rows, size=sample_rows, replace=False))
+        points = np.asarray(matrix[rows], dtype=np.float64)
+        assign, distances = two_means(points)
+        pair_distances = distances[np.triu_indices(len(rows), k=1)]
+        entry['mean_pair_distance'] = float(pair_distances.mean())
+        entry['diameter'] = float(pair_distances.max())
+        entry['spread'] = float((pair_distances > tolerance).mean())
+        entry['bimodality'] = bimodality_coefficient(pair_distances)
+
+        # A chain-merged cluster can be widely spread with unimodal pair distances
+        entry['flagged_by'] = [
+            test for test, fired in (
+                ('spread', entry['spread'] > spread_threshold),
+                ('bimodality', entry['bimodality'] > bimodality_threshold)
+            ) if fired
+        ]
+        entry['flagged'] = len(entry['flagged_by']) == 2 if rule == 'all' else bool(entry['flagged_by'])
+
+        # A lopsided two-means split is no proposal, but the cluster stays flagged
+        part_sizes = (int((~assign).sum()), int(assign.sum()))
+        if min(part_sizes) < MIN_SPLIT_SIZE:
+            continue
+        # Closest faces across the two halves; a chain-merged cluster only
+        # holds together through a few links near the tolerance
+        entry['split_gap'] = float(distances[np.ix_(~assign, assign)].min())
+        if entry['flagged']:
+            entry['proposed_split'] = [
+                [int(row) for row in rows[~assign]],
+                [int(row) for row in rows[assign]]
+            ]
+            entry['proposed_split_images'] = [
+                sorted({encodings_manager.images[i] for i in encodings_manager.image_ids[part] if i >= 0})
+                for part in (rows[~assign], rows[assign])
+            ]
+
+    report.sort(key=lambda entry: (not entry['flagged'], -entry.get('spread', 0)))
+    return report
+
+
+def save_health(results_path, report):
+    path = os.path.join(results_path, HEALTH_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'computed_at': time.time(), 'clusters': report}, f)
+    os.replace(tmp_path, path)
+
+
+def load_health(results_path=RESULTS_FOLDER):
+    """The last persisted report, or None if the job has not run"""
+    try:
+        with open(os.path.join(results_path, HEALTH_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error loading cluster health: {e}")
+        return None
+
+
+def run_health_check(results_path=RESULTS_FOLDER, encodings_manager=None):
+    """Compute and persist the cluster health report; returns it, or None on failure"""
+    try:
+        if encodings_manager is None:
+            encodings_manager = EncodingsManager(results_path, ann_min_rows=None)
+        start = time.perf_counter()
+        report = cluster_health(encodings_manager)
+        save_health(results_path, report)
+        flagged = sum(entry['flagged'] for entry in report)
+        print(f"Checked {len(report)} clusters in {time.perf_counter() - start:.1f}s, {flagged} flagged")
+        return report
+    except Exception as e:
+        print(f"Error checking cluster health: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+
+    report = run_health_check(sys.argv[1] if len(sys.argv) > 1 else RESULTS_FOLDER)
+    for entry in (report or []):
+        if entry['flagged']:
+            split = entry.get('proposed_split')
+            print(f"{entry['cluster_id']}: {entry['size']} faces, spread {entry['spread']:.2f}, "
+                  f"bimodality {entry['bimodality']:.2f} ({', '.join(entry['flagged_by'])}), "
+                  + (f"split {len(split[0])}/{len(split[1])}" if split else "no balanced split"))
+    sys.exit(0 if report is not None else 1)
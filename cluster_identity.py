@@ -0,0 +1,186 @@
+import os
+import json
+import threading
+from pathlib import Path
+from encodings_store import store_lock
+
+IDENTITY_FILE = 'cluster_identity.json'
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_cluster_identity(results_path):
+    """Process-wide ClusterIdentity for results_path, so every reader sees merges at once"""
+    key = os.path.abspath(results_path)
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = ClusterIdentity(results_path)
+        return _instances[key]
+
+
+class ClusterIdentity:
+    """Persisted union-find over cluster ids.
+
+    Merging or renaming a cluster only records a parent link, so the
+    operation is O(1) whatever the cluster size. Readers map any id to its
+    canonical one with find(). Moving the image files is queued and done
+    in the background by apply_pending_moves().
+
+    Several processes share the file: changes are made under the encodings
+    store lock after re-reading it, and readers pick up other processes'
+    changes with reload_if_changed().
+    """
+
+    def __init__(self, results_path):
+        self.results_path = results_path
+        self.identity_file = os.path.join(results_path, IDENTITY_FILE)
+        self._parents = {}
+        self._pending_moves = []
+        self._lock = threading.RLock()
+        self._mover = None
+        self._stamp = None
+        self.load()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.identity_file)
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def reload_if_changed(self):
+        """Re-read the file if another process has written it since it was last read"""
+        if self._file_stamp() != self._stamp:
+            self.load()
+
+    def load(self):
+        try:
+            self._stamp = self._file_stamp()
+            if os.path.exists(self.identity_file):
+                with open(self.identity_file, 'r') as f:
+                    data = json.load(f)
+                self._parents = data.get('parents', {})
+                self._pending_moves = [tuple(move) for move in data.get('pending_moves', [])]
+        except Exception as e:
+            print(f"Error loading cluster identity: {e}")
+
+    def save(self):
+        """Write the map; call under the store lock, after reload_if_changed, so no other process's change is lost"""
+        # Written to a temp file and swapped in so a crash never leaves half a file
+        tmp_path = f"{self.identity_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'parents': self._parents, 'pending_moves': self._pending_moves}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.identity_file)
+        self._stamp = self._file_stamp()
+
+    def find(self, cluster_id):
+        """Canonical id of cluster_id (itself if it was never merged or renamed)"""
+        if cluster_id not in self._parents:
+            return cluster_id
+        root = cluster_id
+        while root in self._parents:
+            root = self._parents[root]
+        # Path compression is kept in memory; the file stays as written by merges
+        while cluster_id != root:
+            self._parents[cluster_id], cluster_id = root, self._parents[cluster_id]
+        return root
+
+    def is_canonical(self, cluster_id):
+        return cluster_id not in self._parents
+
+    def known(self, cluster_id):
+        """Whether cluster_id was ever merged, renamed, or used as a merge or rename target"""
+        return cluster_id in self._parents or cluster_id in self._parents.values()
+
+    def aliases(self, cluster_id):
+        """Every id that resolves to cluster_id's canonical id, including the canonical one"""
+        root = self.find(cluster_id)
+        return [root] + [c for c in list(self._parents) if self.find(c) == root]
+
+    def merge(self, source_cluster, target_cluster):
+        """Point source at target and queue moving its files; returns (success, message)"""
+        with self._lock, store_lock(self.results_path):
+            self.reload_if_changed()
+            source, target = self.find(source_cluster), self.find(target_cluster)
+            if source == target:
+                return False, "Clusters are already merged"
+            self._parents[source] = target
+            self._pending_moves.append((source, target))
+            self.save()
+        return True, f"Merged {source} into {target}"
+
+    def rename(self, cluster_id, new_name, exists=None):
+        """Record that cluster_id is now called new_name.
+
+        new_name must not be an id the identity already knows, nor one
+        exists(new_name) reports as a cluster (e.g. in the store or catalog):
+        renaming onto it would silently merge two people.
+        """
+        with self._lock, store_lock(self.results_path):
+            self.reload_if_changed()
+            old = self.find(cluster_id)
+            if new_name == old:
+                return False, "Cluster already has this name"
+            if self.known(new_name) or (exists and exists(new_name)):
+                return False, "New cluster name already exists"
+            self._parents[old] = new_name
+            self.save()
+        return True, "Cluster renamed successfully"
+
+    def pending_moves(self):
+        with self._lock:
+            return list(self._pending_moves)
+
+    def apply_pending_moves(self):
+        """Move files of merged clusters into their canonical folder"""
+        while True:
+            with self._lock:
+                if not self._pending_moves:
+                    return
+                source, _ = self._pending_moves[0]
+            target = self.find(source)
+            source_dir = Path(self.results_path) / source
+            target_dir = Path(self.results_path) / target
+            try:
+                if source_dir.exists():
+                    target_dir.mkdir(exist_ok=True)
+                    for path in source_dir.iterdir():
+                        dest = target_dir / path.name
+                        if dest.exists():
+                            # Same image already there (e.g. linked for another face)
+                            path.unlink()
+                        else:
+                            path.rename(dest)
+                    source_dir.rmdir()
+            except Exception as e:
+                print(f"Error moving files of {source} to {target}: {e}")
+                return
+            with self._lock, store_lock(self.results_path):
+                self.reload_if_changed()
+                done = [move for move in self._pending_moves if move[0] == source]
+                if done:
+                    self._pending_moves.remove(done[0])
+                self.save()
+
+    def start_background_moves(self):
+        """Run apply_pending_moves on a daemon thread unless one is already running"""
+        with self._lock:
+            if self._mover is not None and self._mover.is_alive():
+                return self._mover
+            self._mover = threading.Thread(target=self.apply_pending_moves, daemon=True)
+            self._mover.start()
+            return self._mover
+
+
+if __name__ == "__main__":
+    import sys
+    from shared_constants import RESULTS_FOLDER
+
+    # python cluster_identity.py [results_folder]: finish queued file moves
+    identity = get_cluster_identity(sys.argv[1] if len(sys.argv) > 1 else RESULTS_FOLDER)
+    print(f"{len(identity.pending_moves())} pending cluster moves")
+    identity.apply_pending_moves()
+    print(f"{len(identity.pending_moves())} moves left")
@@ -0,0 +1,127 @@
+import numpy as np
+
+# Peak memory for the distance blocks and the K x K result matrices
+SIMILARITY_MEMORY_MB = 512
+# float64 temporaries alive per block element: distances, the within-tolerance
+# mask and the per-cluster reductions with their scatter copies
+BLOCK_TEMPORARIES = 4
+# Bytes per cluster pair of the K x K matrices alive together: float32
+# distance sums (turned into means in place), float32 minimums, int64
+# match counts and the float32 match fractions
+RESULT_BYTES_PER_CELL = 4 + 4 + 8 + 4
+
+
+def pairwise_distances(a, b, a_sq=None, b_sq=None):
+    """(len(a), len(b)) Euclidean distances via |a|^2 - 2a.b + |b|^2"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if a_sq is None:
+        a_sq = np.einsum('ij,ij->i', a, a)
+    if b_sq is None:
+        b_sq = np.einsum('ij,ij->i', b, b)
+    sq = a @ b.T
+    sq *= -2
+    sq += a_sq[:, None]
+    sq += b_sq[None, :]
+    np.maximum(sq, 0, out=sq)
+    return np.sqrt(sq, out=sq)
+
+
+def block_rows(memory_mb, cluster_count):
+    """Rows per block so that the result matrices plus one block pair fit in memory_mb"""
+    result_bytes = RESULT_BYTES_PER_CELL * cluster_count * cluster_count
+    available = memory_mb * 1024 * 1024 - result_bytes
+    if available <= 0:
+        raise ValueError(f"{cluster_count} clusters need more than {memory_mb} MB for the similarity matrices")
+    return int(max(64, np.sqrt(available / (8 * BLOCK_TEMPORARIES))))
+
+
+def cluster_similarity(matrix, labels, cluster_count, tolerance=0.6, memory_mb=SIMILARITY_MEMORY_MB):
+    """Aggregate all-pairs encoding distances into K x K cluster similarity matrices.
+
+    Distances are computed block by block over the rows sorted by cluster,
+    and each block is reduced per cluster pair with reduceat, so only one
+    block pair is in memory at a time. Returns a dict of float32 matrices:
+    'match_fraction' (share of encoding pairs within tolerance), 'min'
+    (single linkage) and 'mean' (average linkage), plus int64 'matches'
+    counts and 'sizes'. Diagonal entries describe pairs of distinct encodings within a
+    cluster.
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    sizes = np.bincount(labels, minlength=cluster_count)
+    step = block_rows(memory_mb, cluster_count)
+
+    distance_sum = np.zeros((cluster_count, cluster_count), dtype=np.float32)
+    matches = np.zeros((cluster_count, cluster_count), dtype=np.int64)
+    minimum = np.full((cluster_count, cluster_count), np.inf, dtype=np.float32)
+
+    # Per block: its row range and where each cluster's run of rows starts
+    blocks = []
+    for start in range(0, len(order), step):
+        block_labels = labels[start:start + step]
+        starts = np.concatenate(([0], np.nonzero(np.diff(block_labels))[0] + 1))
+        blocks.append((start, block_labels[starts], starts))
+
+    def load(start):
+        # Rows are gathered per block so the sorted matrix is never copied whole
+        block = np.asarray(matrix[order[start:start + step]], dtype=np.float64)
+        return block, np.einsum('ij,ij->i', block, block)
+
+    for i, (a_start, a_clusters, a_starts) in enumerate(blocks):
+        a, a_sq = load(a_start)
+        for b_start, b_clusters, b_starts in blocks[i:]:
+            b, b_sq = (a, a_sq) if b_start == a_start else load(b_start)
+            distances = pairwise_distances(a, b, a_sq, b_sq)
+            cells = np.ix_(a_clusters, b_clusters)
+            sums = np.add.reduceat(np.add.reduceat(distances, a_starts, axis=0), b_starts, axis=1)
+            counts = np.add.reduceat(
+                np.add.reduceat(distances <= tolerance, a_starts, axis=0, dtype=np.int64), b_starts, axis=1
+            )
+            if b_start == a_start:
+                # An encoding's distance to itself is not a linkage
+                np.fill_diagonal(distances, np.inf)
+            mins = np.minimum.reduceat(np.minimum.reduceat(distances, a_starts, axis=0), b_starts, axis=1)
+            distance_sum[cells] += sums
+            matches[cells] += counts
+            minimum[cells] = np.minimum(minimum[cells], mins)
+            if b_start != a_start:
+                # The mirrored block pair is never computed; fill it from the transpose
+                mirrored = np.ix_(b_clusters, a_clusters)
+                distance_sum[mirrored] += sums.T
+                matches[mirrored] += counts.T
+                minimum[mirrored] = np.minimum(minimum[mirrored], mins.T)
+
+    # Leave out each encoding's zero distance to itself
+    diagonal = np.arange(cluster_count)
+    matches[diagonal, diagonal] -= sizes
+
+    # Ratios are computed a band of rows at a time, the means into
+    # distance_sum in place, so temporaries stay within one block's budget
+    match_fraction = np.zeros((cluster_count, cluster_count), dtype=np.float32)
+    mean = distance_sum
+    band = max(1, step * step // max(cluster_count, 1))
+    for start in range(0, cluster_count, band):
+        rows = np.arange(start, min(start + band, cluster_count))
+        pairs = np.outer(sizes[rows], sizes).astype(np.float64)
+        pairs[rows - start, rows] = sizes[rows] * (sizes[rows] - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            match_fraction[rows] = np.where(pairs > 0, matches[rows] / pairs, 0)
+            mean[rows] = np.where(pairs > 0, mean[rows] / pairs, np.inf)
+
+    return {
+        'match_fraction': match_fraction,
+        'min': minimum,
+        'mean': mean,
+        'matches': matches,
+        'sizes': sizes
+    }
+
+
+def similar_cluster_pairs(similarity, threshold=0.7):
+    """(i, j) index pairs, i < j, whose match fraction exceeds threshold, most similar first"""
+    fraction = np.triu(similarity['match_fraction'], k=1)
+    i, j = np.nonzero(fraction > threshold)
+    order = np.argsort(-fraction[i, j], kind='stable')
+    return list(zip(i[order].tolist(), j[order].tolist()))
@@ -3,28 +3,26 @@ import face_recognition
 import os
 from pathlib import Path
 from PIL import Image
-from shared_constants import RESULTS_FOLDER
+from shared_constants import RESULTS_FOLDER, MAX_DETECTION_SIDE
+from encodings_manager import EncodingsManager
+from stages.process_image import detect_and_encode, primary_face_index
 
-def find_cluster_by_image(image_path, encodings_manager):
+def find_cluster_by_image(image_path, encodings_manager, max_detection_side=MAX_DETECTION_SIDE):
     try:
-        target_image = face_recognition.load_image_file(image_path)
-        target_encodings = face_recognition.face_encodings(target_image)
+        locations, target_encodings = detect_and_encode(image_path, max_detection_side)
         
         if not target_encodings:
             st.warning("⚠️ No face detected in the uploaded image")
             return None
             
-        target_encoding = target_encodings[0]
-        best_match = None
-        best_distance = float('inf')
+        # Look up the most prominent face in the photo
+        target_encoding = target_encodings[primary_face_index(locations)]
         tolerance = 0.6
         
-        for cluster_id, cluster_encodings in encodings_manager.encodings.items():
-            for encoding in cluster_encodings:
-                distance = face_recognition.face_distance([encoding], target_encoding)[0]
-                if distance < tolerance and distance < best_distance:
-                    best_distance = distance
-                    best_match = cluster_id
+        # The session's manager may predate faces the worker or pipeline added since
+        encodings_manager.refresh()
+        
+        best_match, _ = encodings_manager.find_best_match(target_encoding, tolerance)
         
         return best_match
         
@@ -65,7 +63,10 @@ def find_face_page():
             st.subheader("Uploaded Image:")
             st.image(temp_path, width=200)
             
-            cluster_name = find_cluster_by_image(temp_path, results_folder)
+            # Reuse the session's manager rather than loading the store for every lookup
+            if 'encodings_manager' not in st.session_state:
+                st.session_state.encodings_manager = EncodingsManager(results_folder)
+            cluster_name = find_cluster_by_image(temp_path, st.session_state.encodings_manager)
             
             if cluster_name:
                 st.success(f"Face found in cluster: {cluster_name}")
@@ -1,14 +1,55 @@
+import time
 import sqlite3
+import threading
 from datetime import datetime
 from pathlib import Path
 
+DB_PATH = Path("requests.db")
+PAGE_SIZE = 50
+# Claims of a job before it is failed instead of queued again
+MAX_JOB_ATTEMPTS = 3
+
+_local = threading.local()
+
+
+def connect(db_path=DB_PATH):
+    """This thread's connection to db_path, opened and tuned on first use.
+
+    Connections live as long as their thread, so Streamlit sessions and
+    pipeline threads don't pay for opening and configuring one per query.
+    Rows come back as sqlite3.Row, readable by column name or position.
+    Use the connection as a context manager to commit or roll back.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = str(db_path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(key, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers run alongside the single writer
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA busy_timeout = 30000')
+        conn.execute('PRAGMA cache_size = -16000')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA mmap_size = 268435456')
+        connections[key] = conn
+    return conn
+
+
 class Database:
-    def __init__(self):
-        self.db_path = Path("requests.db")
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
         self.init_db()
-    
+
+    @property
+    def conn(self):
+        return connect(self.db_path)
+
     def init_db(self):
-        with sqlite3.connect(str(self.db_path)) as conn:
+        with self.conn as conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS requests (
                     request_id TEXT PRIMARY KEY,
@@ -19,53 +60,318 @@ class Database:
                     status TEXT DEFAULT 'pending'
                 )
             ''')
-    
+            # Listings filter by status and sort newest first
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_status ON requests (status, submitted_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_submitted ON requests (submitted_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_email ON requests (email)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_cluster ON requests (cluster_id)')
+            # Uploads waiting for the worker; a matched job becomes a pending request
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    email TEXT NOT NULL,
+                    image_path TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    cluster_id TEXT,
+                    created_at TIMESTAMP NOT NULL,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+            # Notification emails waiting for, or done with, the SMTP sender
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    to_email TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at TIMESTAMP NOT NULL,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_attempt_at)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox_requests (
+                    message_id INTEGER NOT NULL,
+                    request_id TEXT NOT NULL,
+                    PRIMARY KEY (request_id, message_id)
+                )
+            ''')
+            # Drive folder each cluster was shared in, and what it holds
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS drive_folders (
+                    cluster_id TEXT PRIMARY KEY,
+                    folder_id TEXT NOT NULL,
+                    folder_link TEXT,
+                    synced_at TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS drive_files (
+                    cluster_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    PRIMARY KEY (cluster_id, name)
+                )
+            ''')
+
     def create_request(self, request_id, email, cluster_id, image_path, status='pending'):
-        with sqlite3.connect(str(self.db_path)) as conn:
+        with self.conn as conn:
             conn.execute('''
-                INSERT INTO requests 
+                INSERT INTO requests
                 (request_id, email, cluster_id, image_path, status, submitted_at)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (request_id, email, cluster_id, image_path, status, datetime.now()))
-    
-    def get_pending_requests(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM requests WHERE status = "pending" ORDER BY submitted_at DESC')
-            return cursor.fetchall()
-    
+
+    def get_pending_requests(self, limit=None, offset=0):
+        return self.get_all_requests('pending', limit, offset)
+
     def update_request_status(self, request_id, status):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('UPDATE requests SET status = ? WHERE request_id = ?', (status, request_id))
-            conn.commit()
-    
+        with self.conn as conn:
+            conn.execute('UPDATE requests SET status = ? WHERE request_id = ?', (status, request_id))
+
+    def update_request_statuses(self, request_ids, status):
+        """Set the status of many requests in one transaction"""
+        with self.conn as conn:
+            conn.executemany(
+                'UPDATE requests SET status = ? WHERE request_id = ?',
+                [(status, request_id) for request_id in request_ids]
+            )
+
+    def get_pending_clusters(self):
+        """Pending request count per cluster, largest first"""
+        return self.conn.execute('''
+            SELECT cluster_id, COUNT(*) as count FROM requests
+            WHERE status = 'pending' GROUP BY cluster_id ORDER BY count DESC
+        ''').fetchall()
+
     def get_request_by_id(self, request_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM requests WHERE request_id = ?', (request_id,))
-            return cursor.fetchone()
-    
-    def get_all_requests(self, status=None):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            if status:
-                cursor.execute(
-                    'SELECT * FROM requests WHERE status = ? ORDER BY submitted_at DESC',
-                    (status,)
+        return self.conn.execute('SELECT * FROM requests WHERE request_id = ?', (request_id,)).fetchone()
+
+    def get_request(self, request_id, email):
+        """The request with this id if it was submitted from email, else None"""
+        return self.conn.execute(
+            'SELECT * FROM requests WHERE request_id = ? AND email = ?',
+            (request_id, email)
+        ).fetchone()
+
+    def get_all_requests(self, status=None, limit=None, offset=0):
+        """Requests newest first, optionally one page of limit rows starting at offset"""
+        query = 'SELECT * FROM requests'
+        params = []
+        if status:
+            query += ' WHERE status = ?'
+            params.append(status)
+        query += ' ORDER BY submitted_at DESC'
+        if limit is not None:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([limit, offset])
+        return self.conn.execute(query, params).fetchall()
+
+    def count_requests(self, status=None):
+        if status:
+            return self.conn.execute('SELECT COUNT(*) FROM requests WHERE status = ?', (status,)).fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+    def get_request_stats(self):
+        rows = self.conn.execute('''
+            SELECT
+                status,
+                COUNT(*) as count
+            FROM requests
+            GROUP BY status
+        ''').fetchall()
+        return {row['status']: row['count'] for row in rows}
+
+    def reassign_cluster(self, source_cluster, target_cluster):
+        """Point every request for source_cluster at target_cluster"""
+        with self.conn as conn:
+            cursor = conn.execute(
+                'UPDATE requests SET cluster_id = ? WHERE cluster_id = ?',
+                (target_cluster, source_cluster)
+            )
+            return cursor.rowcount
+
+    def enqueue_job(self, job_id, email, image_path):
+        with self.conn as conn:
+            conn.execute(
+                'INSERT INTO jobs (job_id, email, image_path, created_at) VALUES (?, ?, ?, ?)',
+                (job_id, email, image_path, datetime.now())
+            )
+
+    def claim_jobs(self, limit):
+        """Mark up to limit of the oldest queued jobs as processing and return them"""
+        with self.conn as conn:
+            return conn.execute('''
+                UPDATE jobs SET status = 'processing', started_at = ?, attempts = attempts + 1
+                WHERE job_id IN (
+                    SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT ?
+                )
+                RETURNING *
+            ''', (datetime.now(), limit)).fetchall()
+
+    def requeue_jobs(self, max_attempts=MAX_JOB_ATTEMPTS):
+        """Put jobs left processing by a stopped worker back in the queue.
+
+        Jobs already claimed max_attempts times are failed instead, so an
+        upload that crashes the worker is not retried forever. Returns the
+        number requeued and the failed jobs.
+        """
+        with self.conn as conn:
+            failed = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+                "WHERE status = 'processing' AND attempts >= ? RETURNING *",
+                (f"Gave up after {max_attempts} attempts", datetime.now(), max_attempts)
+            ).fetchall()
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'processing'"
+            ).rowcount
+        return requeued, failed
+
+    def has_retries(self):
+        """Whether a queued job has been claimed before"""
+        return self.conn.execute(
+            "SELECT 1 FROM jobs WHERE status = 'queued' AND attempts > 0 LIMIT 1"
+        ).fetchone() is not None
+
+    def retry_job(self, job, error, max_attempts=MAX_JOB_ATTEMPTS):
+        """Queue a claimed job again, or fail it once it has had max_attempts; returns whether it was queued"""
+        if job['attempts'] >= max_attempts:
+            self.fail_job(job['job_id'], f"Gave up after {job['attempts']} attempts: {error}")
+            return False
+        with self.conn as conn:
+            conn.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE job_id = ?", (job['job_id'],))
+        return True
+
+    def complete_job(self, job, cluster_id):
+        """Record the match and create the pending request for it in one transaction"""
+        with self.conn as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'matched', cluster_id = ?, finished_at = ? WHERE job_id = ?",
+                (cluster_id, datetime.now(), job['job_id'])
+            )
+            conn.execute('''
+                INSERT OR REPLACE INTO requests
+                (request_id, email, cluster_id, image_path, status, submitted_at)
+                VALUES (?, ?, ?, ?, 'pending', ?)
+            ''', (job['job_id'], job['email'], cluster_id, job['image_path'], job['created_at']))
+
+    def fail_job(self, job_id, error):
+        with self.conn as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE job_id = ?",
+                (error, datetime.now(), job_id)
+            )
+
+    def get_job(self, job_id, email):
+        return self.conn.execute(
+            'SELECT * FROM jobs WHERE job_id = ? AND email = ?',
+            (job_id, email)
+        ).fetchone()
+
+    def queue_position(self, job):
+        """Number of queued jobs submitted before job"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?",
+            (job['created_at'],)
+        ).fetchone()[0]
+
+    def get_drive_folder(self, cluster_id):
+        return self.conn.execute('SELECT * FROM drive_folders WHERE cluster_id = ?', (cluster_id,)).fetchone()
+
+    def save_drive_folder(self, cluster_id, folder_id, folder_link):
+        """Point cluster_id at a new Drive folder, forgetting the files of any previous one"""
+        with self.conn as conn:
+            conn.execute('DELETE FROM drive_files WHERE cluster_id = ?', (cluster_id,))
+            conn.execute(
+                'INSERT OR REPLACE INTO drive_folders (cluster_id, folder_id, folder_link, synced_at) VALUES (?, ?, ?, ?)',
+                (cluster_id, folder_id, folder_link, datetime.now())
+            )
+
+    def get_drive_files(self, cluster_id):
+        """{name: row} of the files uploaded to the cluster's folder"""
+        rows = self.conn.execute('SELECT * FROM drive_files WHERE cluster_id = ?', (cluster_id,)).fetchall()
+        return {row['name']: row for row in rows}
+
+    def save_drive_sync(self, cluster_id, uploaded, removed):
+        """Record uploaded (name, content_hash, file_id) and removed names after a sync"""
+        with self.conn as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO drive_files (cluster_id, name, content_hash, file_id) VALUES (?, ?, ?, ?)',
+                [(cluster_id, name, content_hash, file_id) for name, content_hash, file_id in uploaded]
+            )
+            conn.executemany(
+                'DELETE FROM drive_files WHERE cluster_id = ? AND name = ?',
+                [(cluster_id, name) for name in removed]
+            )
+            conn.execute('UPDATE drive_folders SET synced_at = ? WHERE cluster_id = ?', (datetime.now(), cluster_id))
+
+    def queue_notification(self, to_email, subject, body, request_ids=()):
+        """Add an email to the outbox for the requests it answers; returns its message_id"""
+        with self.conn as conn:
+            message_id = conn.execute('''
+                INSERT INTO outbox (to_email, subject, body, next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (to_email, subject, body, time.time(), datetime.now())).lastrowid
+            conn.executemany(
+                'INSERT OR IGNORE INTO outbox_requests (message_id, request_id) VALUES (?, ?)',
+                [(message_id, request_id) for request_id in request_ids]
+            )
+            return message_id
+
+    def claim_notifications(self, limit):
+        """Mark up to limit due queued emails as sending and return them, oldest first"""
+        with self.conn as conn:
+            rows = conn.execute('''
+                UPDATE outbox SET status = 'sending', attempts = attempts + 1
+                WHERE message_id IN (
+                    SELECT message_id FROM outbox
+                    WHERE status = 'queued' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT ?
+                )
+                RETURNING *
+            ''', (time.time(), limit)).fetchall()
+        return sorted(rows, key=lambda row: row['message_id'])
+
+    def requeue_notifications(self):
+        """Put emails left sending by a stopped sender back in the queue; returns how many"""
+        with self.conn as conn:
+            return conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'").rowcount
+
+    def mark_notifications_sent(self, message_ids):
+        with self.conn as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE message_id = ?",
+                [(datetime.now(), message_id) for message_id in message_ids]
+            )
+
+    def retry_notification(self, message_id, error, delay):
+        """Queue the email again in delay seconds, or mark it failed when delay is None"""
+        with self.conn as conn:
+            if delay is None:
+                conn.execute(
+                    "UPDATE outbox SET status = 'failed', last_error = ? WHERE message_id = ?",
+                    (error, message_id)
                 )
             else:
-                cursor.execute('SELECT * FROM requests ORDER BY submitted_at DESC')
-            return cursor.fetchall()
-    
-    def get_request_stats(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    status, 
-                    COUNT(*) as count 
-                FROM requests 
-                GROUP BY status
-            ''')
-            return dict(cursor.fetchall())
+                conn.execute(
+                    "UPDATE outbox SET status = 'queued', last_error = ?, next_attempt_at = ? WHERE message_id = ?",
+                    (error, time.time() + delay, message_id)
+                )
+
+    def get_notification(self, request_id):
+        """The latest email queued for request_id, or None"""
+        return self.conn.execute('''
+            SELECT outbox.* FROM outbox_requests
+            JOIN outbox ON outbox.message_id = outbox_requests.message_id
+            WHERE outbox_requests.request_id = ?
+            ORDER BY outbox.message_id DESC LIMIT 1
+        ''', (request_id,)).fetchone()
@@ -0,0 +1,124 @@
+import os
+import json
+import sqlite3
+import hashlib
+import numpy as np
+
+class EncodingCache:
+    """Persistent cache of detected face locations and encodings per image.
+
+    Files are looked up by (path, size, mtime) first; when that misses the
+    content hash is computed, so renamed or copied photos still hit.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self.hits = 0
+        self.misses = 0
+        self.init_db()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS image_faces (
+                    content_hash TEXT PRIMARY KEY,
+                    locations TEXT NOT NULL,
+                    encodings BLOB NOT NULL,
+                    cluster_id TEXT
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS file_index (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL
+                )
+            ''')
+
+    @staticmethod
+    def hash_file(filepath):
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def content_hash(self, filepath, conn=None):
+        """Hash of the file contents, reusing the stored hash if size and mtime are unchanged"""
+        path = os.path.abspath(filepath)
+        st = os.stat(path)
+        own_conn = conn is None
+        conn = conn or sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute(
+                'SELECT content_hash FROM file_index WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (path, st.st_size, st.st_mtime_ns)
+            ).fetchone()
+            if row:
+                return row[0]
+            content_hash = self.hash_file(path)
+            conn.execute(
+                'INSERT OR REPLACE INTO file_index (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, content_hash)
+            )
+            conn.commit()
+            return content_hash
+        finally:
+            if own_conn:
+                conn.close()
+
+    def lookup(self, filepath):
+        """Return the cached entry for filepath or None.
+
+        An entry is a dict with hash, locations, encodings and the cluster_id
+        the image was last assigned to (None if it was never assigned).
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                content_hash = self.content_hash(filepath, conn)
+                row = conn.execute(
+                    'SELECT locations, encodings, cluster_id FROM image_faces WHERE content_hash = ?',
+                    (content_hash,)
+                ).fetchone()
+        except Exception as e:
+            print(f"Error reading encoding cache: {e}")
+            self.misses += 1
+            return None
+
+        if not row:
+            self.misses += 1
+            return {'hash': content_hash, 'locations': None, 'encodings': None, 'cluster_id': None}
+
+        self.hits += 1
+        locations = [tuple(loc) for loc in json.loads(row[0])]
+        encodings = list(np.frombuffer(row[1], dtype='<f8').reshape(-1, 128))
+        return {'hash': content_hash, 'locations': locations, 'encodings': encodings, 'cluster_id': row[2]}
+
+    def store(self, content_hash, locations, encodings, cluster_id=None):
+        try:
+            blob = np.asarray(encodings, dtype='<f8').reshape(-1, 128).tobytes()
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO image_faces (content_hash, locations, encodings, cluster_id) VALUES (?, ?, ?, ?)',
+                    (content_hash, json.dumps([list(loc) for loc in locations]), blob, cluster_id)
+                )
+            return True
+        except Exception as e:
+            print(f"Error writing encoding cache: {e}")
+            return False
+
+    def mark_assigned(self, content_hash, cluster_id):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                'UPDATE image_faces SET cluster_id = ? WHERE content_hash = ?',
+                (cluster_id, content_hash)
+            )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -2,42 +2,557 @@ import os
 import json
 import numpy as np
 from pathlib import Path
+from contextlib import contextmanager
+from encodings_store import (
+    store_exists, read_header, read_store, read_faces, write_store, migrate_json_store,
+    open_journal, read_journal, append_journal, journal_size, store_lock, store_stamp
+)
+from ann_index import IVFIndex, DEFAULT_NPROBE
+from cluster_identity import get_cluster_identity
+from merge_candidates import MergeCandidates, MERGE_CANDIDATES_FILE
+
+ENCODING_DIM = 128
+# The journal is compacted once it holds JOURNAL_COMPACT_FRACTION of the
+# snapshot's rows (and at least JOURNAL_COMPACT_EVERY), so the cost of
+# rewriting the snapshot stays amortized O(1) per append as the store grows
+JOURNAL_COMPACT_EVERY = 5000
+JOURNAL_COMPACT_FRACTION = 0.25
+BLOCK_ROWS = 65536
+# Stores with at least this many encodings are searched through the IVF index
+ANN_MIN_ROWS = 200000
+# Retrain the index once the store has grown this much since training
+ANN_RETRAIN_GROWTH = 4
+# Exact searches visit at most this many clusters one by one; past that the
+# bounds are not pruning and one vectorized pass over every row is faster
+EXACT_SCAN_CLUSTERS = 64
 
 class EncodingsManager:
-    def __init__(self, results_path):
+    def __init__(self, results_path, compact_every=JOURNAL_COMPACT_EVERY, fsync=True,
+                 ann_min_rows=ANN_MIN_ROWS, nprobe=DEFAULT_NPROBE, compact_fraction=JOURNAL_COMPACT_FRACTION):
         self.results_path = results_path
         self.encodings_file = os.path.join(results_path, 'encodings.json')
-        self.encodings = self.load_encodings()
-        
+        self.compact_every = compact_every
+        self.compact_fraction = compact_fraction
+        self.fsync = fsync
+
+        # New faces are appended to a journal on top of the last snapshot and
+        # folded into a new snapshot once the journal is large enough. The
+        # journal is only opened, written and trimmed under the exclusive
+        # store lock; _journal_length is the end of the last record read.
+        self._journal_records = 0
+        self._journal_length = None
+        self._snapshot_count = 0
+        self._generation = 0
+        self._stamp = None
+        self._lock_held = False
+
+        # Stacked (N, 128) matrix with one cluster label per row. Buffers grow
+        # geometrically so appending a face is amortized O(1).
+        self.clusters = []
+        self._cluster_index = {}
+        self._matrix = np.empty((0, ENCODING_DIM))
+        self._labels = np.empty(0, dtype=np.int32)
+        self._sq_norms = np.empty(0)
+        self._count = 0
+
+        # Per-face records: the image each row came from and its (top, right,
+        # bottom, left) box. Rows migrated from encodings.json have no image (-1).
+        self.images = []
+        self._image_index = {}
+        self._image_ids = np.empty(0, dtype=np.int32)
+        self._boxes = np.empty((0, 4), dtype=np.int32)
+        self._image_rows = None
+
+        # Per-cluster centroid, member count, member rows and a radius that is
+        # an upper bound on the distance from the centroid to any member.
+        # Searches skip clusters whose centroid distance minus radius cannot
+        # beat the best match so far.
+        self._centroids = np.empty((0, ENCODING_DIM))
+        self._radii = np.empty(0)
+        self._sizes = np.empty(0, dtype=np.int64)
+        self._exact_sizes = np.empty(0, dtype=np.int64)
+        self._cluster_rows = []
+
+        # Optional approximate index, built once the store reaches
+        # ann_min_rows encodings (None disables it)
+        self.ann_min_rows = ann_min_rows
+        self.nprobe = nprobe
+        self.ann_index = None
+
         # Create results directory if it doesn't exist
         os.makedirs(results_path, exist_ok=True)
-    
+
+        # Merged and renamed clusters keep their rows under the old id until
+        # the next compaction; every id handed out is resolved through this
+        self.identity = get_cluster_identity(results_path)
+        # Near-miss evidence between clusters, recorded by assign_faces
+        self.merge_candidates = MergeCandidates(os.path.join(results_path, MERGE_CANDIDATES_FILE))
+        self.load_encodings()
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._count]
+
+    @property
+    def labels(self):
+        return self._labels[:self._count]
+
+    @property
+    def encodings(self):
+        """Read-only {cluster_id: [encoding, ...]} view of the stored encodings"""
+        names = [self.identity.find(cluster_id) for cluster_id in self.clusters]
+        encodings = {cluster_id: [] for cluster_id in names}
+        matrix = self.matrix
+        for row, label in enumerate(self.labels):
+            encodings[names[label]].append(matrix[row])
+        return encodings
+
+    @property
+    def boxes(self):
+        return self._boxes[:self._count]
+
+    @property
+    def image_ids(self):
+        return self._image_ids[:self._count]
+
+    def faces_in_image(self, image_name):
+        """Per-face records [{'row', 'cluster_id', 'box'}] stored for an image"""
+        if self._image_rows is None:
+            # Built on first use so cold start does not pay for it
+            self._image_rows = {}
+            for row, image_id in enumerate(self.image_ids):
+                if image_id >= 0:
+                    self._image_rows.setdefault(int(image_id), []).append(row)
+        image_id = self._image_index.get(image_name)
+        rows = self._image_rows.get(image_id, []) if image_id is not None else []
+        return [
+            {'row': row, 'cluster_id': self.identity.find(self.clusters[self.labels[row]]), 'box': tuple(int(v) for v in self.boxes[row])}
+            for row in rows
+        ]
+
+    def cluster_rows(self, cluster_id):
+        """Row numbers of the encodings in cluster_id, including clusters merged into it"""
+        rows = [
+            self._cluster_rows[self._cluster_index[alias]]
+            for alias in self.identity.aliases(cluster_id) if alias in self._cluster_index
+        ]
+        return np.asarray(sorted(row for part in rows for row in part), dtype=np.int64)
+
+    def cluster_count(self):
+        return len({self.identity.find(cluster_id) for cluster_id in self.clusters})
+
+    def has_cluster(self, cluster_id):
+        return any(alias in self._cluster_index for alias in self.identity.aliases(cluster_id))
+
     def load_encodings(self):
-        try:
-            if os.path.exists(self.encodings_file):
-                with open(self.encodings_file, 'r') as f:
-                    data = json.load(f)
-                    return {k: [np.array(enc) for enc in v] for k, v in data.items()}
-            return {}
-        except Exception as e:
-            print(f"Error loading encodings: {e}")
-            return {}
+        """Read the snapshot and replay the journal.
+
+        Errors are raised rather than starting from an empty store, which the
+        next compaction would then write over the real one.
+        """
+        # Convert the legacy JSON file once, then always read the binary store
+        if not store_exists(self.results_path) and os.path.exists(self.encodings_file):
+            with self._store_lock():
+                if not store_exists(self.results_path):
+                    migrate_json_store(self.encodings_file, self.results_path)
+
+        self.ann_index = None
+        with self._store_lock(exclusive=False):
+            self._stamp = store_stamp(self.results_path)
+            if store_exists(self.results_path):
+                header = read_header(self.results_path)
+                self._generation = header.get('generation', 0)
+                matrix, labels, clusters = read_store(self.results_path, header=header)
+                self._set_arrays(matrix, labels, clusters, read_faces(self.results_path, len(labels), header))
+            else:
+                self._generation = 0
+                self._set_arrays(np.empty((0, ENCODING_DIM)), np.empty(0, dtype=np.int32), [])
+            records, self._journal_length = read_journal(self.results_path, self._generation)
+        self._snapshot_count = self._count
+        self._build_centroids()
+
+        # Replay faces added since the snapshot was written
+        self._replay(records)
+        self._journal_records = len(records)
+        self._load_ann_index()
+
+    def _replay(self, records):
+        for meta, encoding in records:
+            self._append(meta['cluster_id'], encoding, meta.get('image'), meta.get('box'))
+
+    @contextmanager
+    def _store_lock(self, exclusive=True):
+        """Hold the store lock; nested uses inside a held lock are no-ops"""
+        if self._lock_held:
+            yield
+            return
+        with store_lock(self.results_path, exclusive):
+            self._lock_held = True
+            try:
+                yield
+            finally:
+                self._lock_held = False
+
+    def _catch_up(self):
+        """Bring memory up to date with the store; call with the store lock held.
+
+        Reloads after another process compacted, otherwise replays the journal
+        records other processes appended since the last read. Merges and
+        renames made elsewhere are picked up first, so new cluster ids never
+        reuse an id that now resolves to another cluster.
+        """
+        self.identity.reload_if_changed()
+        if store_stamp(self.results_path) != self._stamp:
+            self.load_encodings()
+            return
+        if self._journal_length is not None and journal_size(self.results_path) <= self._journal_length:
+            return
+        records, journal_length = read_journal(self.results_path, self._generation, self._journal_length)
+        if journal_length is None:
+            # Nobody has started this generation's journal yet
+            return
+        self._journal_length = journal_length
+        self._replay(records)
+        self._journal_records += len(records)
+
+    def _set_arrays(self, matrix, labels, clusters, faces=None):
+        # The memory-mapped matrix is used as-is until the first append
+        self.clusters = list(clusters)
+        self._cluster_index = {cluster_id: idx for idx, cluster_id in enumerate(self.clusters)}
+        self._matrix = matrix
+        self._labels = np.asarray(labels, dtype=np.int32)
+        self._sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        self._count = len(labels)
+
+        if faces is None:
+            faces = (np.zeros((self._count, 4), dtype=np.int32), np.full(self._count, -1, dtype=np.int32), [])
+        self._boxes = np.asarray(faces[0], dtype=np.int32)
+        self._image_ids = np.asarray(faces[1], dtype=np.int32)
+        self.images = list(faces[2])
+        self._image_index = {image: idx for idx, image in enumerate(self.images)}
+        self._image_rows = None
+
+    def _build_centroids(self):
+        """Recompute exact centroids, radii and member rows from the stored encodings"""
+        k = len(self.clusters)
+        labels = self.labels
+        matrix = self.matrix
+        sizes = np.bincount(labels, minlength=k).astype(np.int64)
+
+        sums = np.zeros((k, ENCODING_DIM))
+        for start in range(0, self._count, BLOCK_ROWS):
+            block = slice(start, start + BLOCK_ROWS)
+            np.add.at(sums, labels[block], matrix[block])
+        centroids = sums / np.maximum(sizes, 1)[:, None]
+
+        radii = np.zeros(k)
+        for start in range(0, self._count, BLOCK_ROWS):
+            block = slice(start, start + BLOCK_ROWS)
+            distances = np.linalg.norm(matrix[block] - centroids[labels[block]], axis=1)
+            np.maximum.at(radii, labels[block], distances)
+
+        order = np.argsort(labels, kind='stable')
+        self._cluster_rows = [rows.tolist() for rows in np.split(order, np.cumsum(sizes)[:-1])] if k else []
+        self._centroids, self._radii, self._sizes = centroids, radii, sizes
+        self._exact_sizes = sizes.copy()
+
+    def _ann_enabled(self):
+        return self.ann_min_rows is not None and self._count >= self.ann_min_rows
+
+    def _load_ann_index(self):
+        """Load the persisted index and index rows replayed from the journal"""
+        if not self._ann_enabled():
+            return
+        index = IVFIndex.load(self.results_path, self.nprobe, self._generation)
+        if index is None or index.count != self._snapshot_count:
+            self._train_ann_index()
+            return
+        rows = np.arange(index.count, self._count)
+        index.add(rows, self.matrix[index.count:])
+        self.ann_index = index
+
+    def _train_ann_index(self):
+        print(f"Building ANN index over {self._count} encodings")
+        index = IVFIndex(self.nprobe)
+        index.train(self.matrix)
+        self.ann_index = index
+
+    def _grow_clusters(self, needed):
+        capacity = len(self._centroids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 64)
+        k = len(self._cluster_rows)
+        centroids = np.zeros((capacity, ENCODING_DIM))
+        centroids[:k] = self._centroids[:k]
+        radii = np.zeros(capacity)
+        radii[:k] = self._radii[:k]
+        sizes = np.zeros(capacity, dtype=np.int64)
+        sizes[:k] = self._sizes[:k]
+        exact_sizes = np.zeros(capacity, dtype=np.int64)
+        exact_sizes[:k] = self._exact_sizes[:k]
+        self._centroids, self._radii, self._sizes = centroids, radii, sizes
+        self._exact_sizes = exact_sizes
+
+    def _update_centroid(self, k, row, encoding):
+        if k == len(self._cluster_rows):
+            self._grow_clusters(k + 1)
+            self._cluster_rows.append([])
+
+        n = self._sizes[k]
+        old = self._centroids[k].copy()
+        new = old + (encoding - old) / (n + 1)
+        self._centroids[k] = new
+        self._sizes[k] = n + 1
+        self._cluster_rows[k].append(row)
+
+        if n + 1 >= 2 * self._exact_sizes[k]:
+            # Recompute exactly each time the cluster doubles: amortized O(1)
+            # per face, and keeps the bound from drifting loose
+            rows = np.asarray(self._cluster_rows[k])
+            self._radii[k] = np.linalg.norm(self._matrix[rows] - new, axis=1).max()
+            self._exact_sizes[k] = n + 1
+        else:
+            # Members moved at most |new - old| relative to the centroid
+            self._radii[k] = max(self._radii[k] + np.linalg.norm(new - old), np.linalg.norm(encoding - new))
+
+    def _grow(self, needed):
+        capacity = len(self._matrix)
+        if needed <= capacity and self._matrix.flags.writeable:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        matrix = np.empty((capacity, ENCODING_DIM), dtype=np.float64)
+        matrix[:self._count] = self._matrix[:self._count]
+        labels = np.empty(capacity, dtype=np.int32)
+        labels[:self._count] = self._labels[:self._count]
+        sq_norms = np.empty(capacity)
+        sq_norms[:self._count] = self._sq_norms[:self._count]
+        boxes = np.zeros((capacity, 4), dtype=np.int32)
+        boxes[:self._count] = self._boxes[:self._count]
+        image_ids = np.full(capacity, -1, dtype=np.int32)
+        image_ids[:self._count] = self._image_ids[:self._count]
+        self._matrix, self._labels, self._sq_norms = matrix, labels, sq_norms
+        self._boxes, self._image_ids = boxes, image_ids
+
+    def _fold_merges(self):
+        """Relabel rows of merged or renamed clusters with their canonical id"""
+        canonical = [self.identity.find(cluster_id) for cluster_id in self.clusters]
+        if canonical == self.clusters:
+            return
+        self.clusters = list(dict.fromkeys(canonical))
+        self._cluster_index = {cluster_id: idx for idx, cluster_id in enumerate(self.clusters)}
+        remap = np.array([self._cluster_index[cluster_id] for cluster_id in canonical], dtype=np.int32)
+        # In place: the label buffer keeps its spare capacity for later appends
+        self._labels[:self._count] = remap[self.labels]
 
     def save_encodings(self):
+        """Compact: fold the journal and cluster merges into a new snapshot and start an empty journal"""
         try:
-            serializable_encodings = {
-                k: [enc.tolist() for enc in v] 
-                for k, v in self.encodings.items()
-            }
-            with open(self.encodings_file, 'w') as f:
-                json.dump(serializable_encodings, f)
+            self.merge_candidates.flush()
+            with self._store_lock():
+                # Faces other processes journalled since the last read go into the snapshot too
+                self._catch_up()
+                self._fold_merges()
+                generation = self._generation + 1
+                write_store(
+                    self.results_path, self.matrix, self.labels, self.clusters,
+                    generation=generation, faces=(self.boxes, self.image_ids, self.images)
+                )
+                self._generation = generation
+                with open_journal(self.results_path, generation) as journal:
+                    self._journal_length = journal.tell()
+                self._stamp = store_stamp(self.results_path)
+                self._snapshot_count = self._count
+                self._journal_records = 0
+                # Tighten radii that grew loose through incremental updates
+                self._build_centroids()
+
+                if self._ann_enabled():
+                    if self.ann_index is None or self._count >= ANN_RETRAIN_GROWTH * self.ann_index.trained_count:
+                        self._train_ann_index()
+                    self.ann_index.save(self.results_path, generation)
             return True
         except Exception as e:
             print(f"Error saving encodings: {e}")
             return False
 
-    def add_encoding(self, cluster_id, encoding):
-        if cluster_id not in self.encodings:
-            self.encodings[cluster_id] = []
-        self.encodings[cluster_id].append(encoding)
-        self.save_encodings()
\ No newline at end of file
+    def refresh(self):
+        """Pick up faces and compactions written by other processes since the last read"""
+        with self._store_lock(exclusive=False):
+            self._catch_up()
+
+    def add_encoding(self, cluster_id, encoding, image=None, box=None):
+        """Add a face and append it to the journal; durable once this returns.
+
+        cluster_id None starts a new cluster, named under the store lock so
+        two processes never hand out the same id. image is the stored image
+        name the face was found in and box its (top, right, bottom, left)
+        location. Returns the cluster_id the face was stored under.
+        """
+        encoding = np.asarray(encoding, dtype=np.float64)
+        box = [int(v) for v in box] if box is not None else None
+        with self._store_lock():
+            self._catch_up()
+            cluster_id = self.identity.find(cluster_id) if cluster_id else self.new_cluster_id()
+            meta = {'cluster_id': cluster_id}
+            if image is not None:
+                meta['image'] = image
+                meta['box'] = box
+            with open_journal(self.results_path, self._generation, self._journal_length) as journal:
+                append_journal(journal, meta, encoding, fsync=self.fsync)
+                self._journal_length = journal.tell()
+            self._append(cluster_id, encoding, image, box)
+            self._journal_records += 1
+
+            if self._journal_records >= max(self.compact_every, self.compact_fraction * self._snapshot_count):
+                self.save_encodings()
+        return cluster_id
+
+    def _append(self, cluster_id, encoding, image=None, box=None):
+        if cluster_id not in self._cluster_index:
+            self._cluster_index[cluster_id] = len(self.clusters)
+            self.clusters.append(cluster_id)
+
+        image_id = -1
+        if image is not None:
+            if image not in self._image_index:
+                self._image_index[image] = len(self.images)
+                self.images.append(image)
+            image_id = self._image_index[image]
+
+        row = self._count
+        self._grow(row + 1)
+        self._matrix[row] = encoding
+        self._labels[row] = self._cluster_index[cluster_id]
+        self._sq_norms[row] = encoding @ encoding
+        self._boxes[row] = box if box is not None else (0, 0, 0, 0)
+        self._image_ids[row] = image_id
+        self._count += 1
+        self._update_centroid(self._labels[row], row, encoding)
+        if self.ann_index is not None:
+            self.ann_index.add(row, encoding)
+        if self._image_rows is not None and image_id >= 0:
+            self._image_rows.setdefault(image_id, []).append(row)
+
+    def close(self):
+        self.merge_candidates.flush()
+
+    def cluster_id_used(self, cluster_id):
+        """Whether cluster_id holds encodings or is a merged, renamed or target id"""
+        return cluster_id in self._cluster_index or self.identity.known(cluster_id)
+
+    def new_cluster_id(self):
+        """Next free cluster_<n> name"""
+        n = len(self.clusters) + 1
+        while self.cluster_id_used(f"cluster_{n}"):
+            n += 1
+        return f"cluster_{n}"
+
+    def face_distances(self, encoding):
+        """Euclidean distance from encoding to every stored encoding, in one pass.
+
+        Uses |a - b|^2 = |a|^2 - 2a.b + |b|^2 with cached row norms, so no
+        (N, 128) temporary is allocated.
+        """
+        if self._count == 0:
+            return np.empty(0)
+        encoding = np.asarray(encoding, dtype=np.float64)
+        sq = self._sq_norms[:self._count] - 2 * (self.matrix @ encoding) + encoding @ encoding
+        return np.sqrt(np.maximum(sq, 0))
+
+    def _row_distances(self, rows, encoding):
+        rows = np.asarray(rows)
+        sq = self._sq_norms[rows] - 2 * (self._matrix[rows] @ encoding) + encoding @ encoding
+        return np.sqrt(np.maximum(sq, 0))
+
+    def _lower_bounds(self, encoding):
+        """Lower bound on the distance from encoding to any member of each cluster"""
+        k = len(self.clusters)
+        # Small slack absorbs rounding in the incrementally updated radii
+        return np.linalg.norm(self._centroids[:k] - encoding, axis=1) - self._radii[:k] - 1e-9
+
+    def find_best_match(self, encoding, tolerance=0.6, exact=False):
+        """Return (cluster_id, distance) of the nearest encoding within tolerance.
+
+        Clusters are visited in order of their centroid lower bound and the
+        scan stops once no remaining cluster can beat the best match; when
+        the bounds keep more than EXACT_SCAN_CLUSTERS clusters in play, every
+        row is compared in one pass instead. Once the IVF index is built the search is approximate unless exact=True.
+        Returns (None, None) when nothing is within tolerance.
+        """
+        if self._count == 0:
+            return None, None
+        encoding = np.asarray(encoding, dtype=np.float64)
+        if self.ann_index is not None and not exact:
+            return self._ann_best_match(encoding, tolerance)
+        lower = self._lower_bounds(encoding)
+        candidates = np.nonzero(lower < tolerance)[0]
+        candidates = candidates[np.argsort(lower[candidates], kind='stable')]
+
+        best_distance, best_cluster = tolerance, None
+        for visited, k in enumerate(candidates):
+            if lower[k] >= best_distance:
+                break
+            if visited == EXACT_SCAN_CLUSTERS:
+                return self._scan_best_match(encoding, tolerance)
+            if not self._cluster_rows[k]:
+                continue
+            distance = float(self._row_distances(self._cluster_rows[k], encoding).min())
+            if distance < best_distance:
+                best_distance, best_cluster = distance, k
+
+        if best_cluster is None:
+            return None, None
+        return self.identity.find(self.clusters[best_cluster]), best_distance
+
+    def _scan_best_match(self, encoding, tolerance):
+        distances = self.face_distances(encoding)
+        row = int(np.argmin(distances))
+        if distances[row] >= tolerance:
+            return None, None
+        return self.identity.find(self.clusters[self._labels[row]]), float(distances[row])
+
+    def _ann_best_match(self, encoding, tolerance):
+        rows = self.ann_index.candidates(encoding)
+        if len(rows) == 0:
+            return None, None
+        distances = self._row_distances(rows, encoding)
+        best = int(np.argmin(distances))
+        if distances[best] >= tolerance:
+            return None, None
+        return self.identity.find(self.clusters[self._labels[rows[best]]]), float(distances[best])
+
+    def find_near_clusters(self, encoding, radius, exact=False):
+        """{cluster_id: distance} of every cluster with an encoding closer than radius.
+
+        Like find_best_match this goes through the IVF index once it is built,
+        and otherwise prunes clusters with the centroid lower bound.
+        """
+        if self._count == 0:
+            return {}
+        encoding = np.asarray(encoding, dtype=np.float64)
+        if self.ann_index is not None and not exact:
+            rows = self.ann_index.candidates(encoding)
+            distances = self._row_distances(rows, encoding)
+            close = distances < radius
+            labels, distances = self._labels[rows[close]], distances[close]
+        else:
+            candidates = np.nonzero(self._lower_bounds(encoding) < radius)[0]
+            if len(candidates) > EXACT_SCAN_CLUSTERS:
+                distances = self.face_distances(encoding)
+                close = distances < radius
+                labels, distances = self.labels[close], distances[close]
+            else:
+                labels = [k for k in candidates if self._cluster_rows[k]]
+                distances = [float(self._row_distances(self._cluster_rows[k], encoding).min()) for k in labels]
+
+        near = {}
+        for label, distance in zip(labels, distances):
+            if distance < radius:
+                cluster_id = self.identity.find(self.clusters[label])
+                near[cluster_id] = min(float(distance), near.get(cluster_id, radius))
+        return near
+
+    def find_matching_clusters(self, encoding, tolerance=0.6):
+        """All cluster_ids with at least one encoding within tolerance"""
+        return list(self.find_near_clusters(encoding, tolerance, exact=True))
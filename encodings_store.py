@@ -0,0 +1,313 @@
+import os
+import json
+import struct
+import zlib
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking where flock is unavailable (Windows)
+    fcntl = None
+
+STORE_VERSION = 1
+HEADER_FILE = 'encodings_header.json'
+MATRIX_FILE = 'encodings_matrix.npy'
+LABELS_FILE = 'encodings_labels.npy'
+BOXES_FILE = 'encodings_boxes.npy'
+IMAGE_IDS_FILE = 'encodings_image_ids.npy'
+IMAGES_FILE = 'encodings_images.json'
+# Snapshot data files, written under per-generation names and listed in the header
+DATA_FILES = {
+    'matrix': MATRIX_FILE,
+    'labels': LABELS_FILE,
+    'boxes': BOXES_FILE,
+    'image_ids': IMAGE_IDS_FILE,
+    'images': IMAGES_FILE
+}
+JOURNAL_FILE = 'encodings.journal'
+LOCK_FILE = 'encodings.lock'
+
+# Journal file: magic + generation, then records of
+# <payload length><crc32>[<meta length><meta json><float64 vector>]
+JOURNAL_MAGIC = b'FCJ1'
+JOURNAL_HEADER = struct.Struct('<4sI')
+RECORD_HEADER = struct.Struct('<II')
+META_LENGTH = struct.Struct('<H')
+
+
+def store_exists(store_path):
+    """Check whether a binary encodings store has been written to store_path"""
+    return os.path.exists(os.path.join(store_path, HEADER_FILE))
+
+
+@contextmanager
+def store_lock(store_path, exclusive=True):
+    """Hold the store's inter-process lock.
+
+    Writers (journal appends, compaction) hold it exclusively; readers hold
+    it shared so a compaction cannot replace the snapshot mid-read. The lock
+    is per open file, so a process must not take it again while holding it.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    with open(os.path.join(store_path, LOCK_FILE), 'ab') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        # Closing the file releases the lock
+        yield
+
+
+def store_stamp(store_path):
+    """Identifies the snapshot on disk: changes whenever a compaction replaces the header"""
+    try:
+        stat = os.stat(os.path.join(store_path, HEADER_FILE))
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+def _replace_file(path, write):
+    # Write to a temp file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _generation_file(name, generation):
+    """encodings_matrix.npy -> encodings_matrix.<generation>.npy"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{generation}{ext}"
+
+
+def _data_file(header, key):
+    # Stores written before data files were named per generation use the fixed names
+    return header.get('files', {}).get(key, DATA_FILES[key])
+
+
+def write_store(store_path, matrix, labels, clusters, dtype='float64', generation=0, faces=None):
+    """Write encodings matrix, row labels and header to store_path.
+
+    matrix is (N, dim), labels is (N,) with indexes into the clusters list.
+    faces is an optional (boxes, image_ids, images) tuple describing where
+    each row was found: (N, 4) boxes, (N,) indexes into images (-1 = unknown).
+    generation identifies the journal that continues this snapshot.
+
+    Data files are written under names that include the generation and the
+    header naming them is swapped in last: replacing the header is the one
+    commit point, so a crash at any step leaves the previous snapshot whole.
+    Files of older snapshots are removed after the commit.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    labels = np.ascontiguousarray(labels, dtype=np.int32)
+    if matrix.ndim != 2 or len(matrix) != len(labels):
+        raise ValueError("matrix must be (N, dim) with one label per row")
+
+    if faces is None:
+        faces = (np.zeros((len(labels), 4)), np.full(len(labels), -1), [])
+    boxes = np.ascontiguousarray(faces[0], dtype=np.int32).reshape(-1, 4)
+    image_ids = np.ascontiguousarray(faces[1], dtype=np.int32)
+    if len(boxes) != len(labels) or len(image_ids) != len(labels):
+        raise ValueError("faces must describe every row of the matrix")
+
+    files = {key: _generation_file(name, generation) for key, name in DATA_FILES.items()}
+    _replace_file(os.path.join(store_path, files['matrix']), lambda f: np.save(f, matrix))
+    _replace_file(os.path.join(store_path, files['labels']), lambda f: np.save(f, labels))
+    _replace_file(os.path.join(store_path, files['boxes']), lambda f: np.save(f, boxes))
+    _replace_file(os.path.join(store_path, files['image_ids']), lambda f: np.save(f, image_ids))
+    _replace_file(
+        os.path.join(store_path, files['images']),
+        lambda f: f.write(json.dumps(list(faces[2])).encode('utf-8'))
+    )
+
+    header = {
+        'version': STORE_VERSION,
+        'dtype': matrix.dtype.name,
+        'dim': int(matrix.shape[1]),
+        'count': int(matrix.shape[0]),
+        'generation': int(generation),
+        'files': files,
+        'clusters': list(clusters)
+    }
+    _replace_file(
+        os.path.join(store_path, HEADER_FILE),
+        lambda f: f.write(json.dumps(header).encode('utf-8'))
+    )
+    _remove_stale_files(store_path, set(files.values()))
+
+
+def _remove_stale_files(store_path, keep):
+    """Delete data files of earlier snapshots (and temp files of interrupted writes)"""
+    prefixes = tuple(f"{os.path.splitext(name)[0]}." for name in DATA_FILES.values())
+    for name in os.listdir(store_path):
+        if name.startswith(prefixes) and name not in keep:
+            try:
+                os.remove(os.path.join(store_path, name))
+            except OSError as e:
+                print(f"Error removing old store file {name}: {e}")
+
+
+def read_header(store_path):
+    with open(os.path.join(store_path, HEADER_FILE), 'r') as f:
+        return json.load(f)
+
+
+def read_store(store_path, mmap=True, header=None):
+    """Read a binary encodings store.
+
+    Returns (matrix, labels, clusters). With mmap=True the matrix is a
+    read-only memory map, so processes opening the same store share one copy
+    in the page cache. header can be passed when the caller already read it.
+    """
+    header = header or read_header(store_path)
+    if header.get('version') != STORE_VERSION:
+        raise ValueError(f"Unsupported encodings store version: {header.get('version')}")
+
+    mmap_mode = 'r' if mmap else None
+    count = header['count']
+    if count == 0:
+        matrix = np.empty((0, header['dim']), dtype=header['dtype'])
+        labels = np.empty(0, dtype=np.int32)
+    else:
+        matrix = np.load(os.path.join(store_path, _data_file(header, 'matrix')), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(store_path, _data_file(header, 'labels')))
+
+    if matrix.shape != (count, header['dim']) or len(labels) != count:
+        raise ValueError("Encodings store is inconsistent with its header")
+    return matrix, labels, header['clusters']
+
+
+def read_faces(store_path, count, header=None):
+    """Read per-row (boxes, image_ids, images), with empty records for stores written without them"""
+    try:
+        header = header or read_header(store_path)
+        boxes = np.load(os.path.join(store_path, _data_file(header, 'boxes')))
+        image_ids = np.load(os.path.join(store_path, _data_file(header, 'image_ids')))
+        with open(os.path.join(store_path, _data_file(header, 'images')), 'r') as f:
+            images = json.load(f)
+        if len(boxes) == count and len(image_ids) == count:
+            return boxes, image_ids, images
+    except (OSError, ValueError):
+        pass
+    return np.zeros((count, 4), dtype=np.int32), np.full(count, -1, dtype=np.int32), []
+
+
+def open_journal(store_path, generation, valid_length=None):
+    """Open the journal for appending, starting a fresh one if it belongs to another generation.
+
+    Only call this while holding the store lock exclusively. A journal whose
+    generation differs from the snapshot has already been folded into it
+    (compaction stopped before resetting the journal). valid_length, the end
+    of the last intact record, cuts off a torn tail so new records are not
+    appended after it.
+    """
+    path = os.path.join(store_path, JOURNAL_FILE)
+    if journal_generation(store_path) != generation:
+        _replace_file(path, lambda f: f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, generation)))
+    elif valid_length is not None and os.path.getsize(path) > valid_length:
+        os.truncate(path, valid_length)
+    return open(path, 'ab')
+
+
+def journal_generation(store_path):
+    path = os.path.join(store_path, JOURNAL_FILE)
+    try:
+        with open(path, 'rb') as f:
+            magic, generation = JOURNAL_HEADER.unpack(f.read(JOURNAL_HEADER.size))
+        return generation if magic == JOURNAL_MAGIC else None
+    except (OSError, struct.error):
+        return None
+
+
+def journal_size(store_path):
+    try:
+        return os.path.getsize(os.path.join(store_path, JOURNAL_FILE))
+    except OSError:
+        return 0
+
+
+def append_journal(journal, meta, encoding, fsync=True):
+    """Append one (meta, encoding) record and make it durable"""
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    payload = META_LENGTH.pack(len(meta_bytes)) + meta_bytes + np.asarray(encoding, dtype='<f8').tobytes()
+    journal.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    journal.flush()
+    if fsync:
+        os.fsync(journal.fileno())
+
+
+def read_journal(store_path, generation, start=None):
+    """Read (meta, encoding) records from the journal of the given generation.
+
+    start is the offset of the first record to read, to pick up records
+    appended since an earlier read. Returns (records, valid_length). Replay
+    stops at the first torn or corrupt record: the tail of an append that is
+    still being written, or was interrupted by a crash.
+    """
+    records = []
+    if journal_generation(store_path) != generation:
+        return records, None
+    with open(os.path.join(store_path, JOURNAL_FILE), 'rb') as f:
+        valid_length = start or JOURNAL_HEADER.size
+        f.seek(valid_length)
+        while True:
+            record_header = f.read(RECORD_HEADER.size)
+            if len(record_header) < RECORD_HEADER.size:
+                break
+            length, crc = RECORD_HEADER.unpack(record_header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                print("Ignoring incomplete record at end of encodings journal")
+                break
+            (meta_length,) = META_LENGTH.unpack_from(payload)
+            meta_end = META_LENGTH.size + meta_length
+            meta = json.loads(payload[META_LENGTH.size:meta_end].decode('utf-8'))
+            records.append((meta, np.frombuffer(payload[meta_end:], dtype='<f8')))
+            valid_length = f.tell()
+    return records, valid_length
+
+
+def stored_cluster_ids(store_path):
+    """Cluster ids in the snapshot header and the journal, read without the store lock"""
+    header = read_header(store_path) if store_exists(store_path) else {'clusters': []}
+    records, _ = read_journal(store_path, header.get('generation', 0))
+    return set(header['clusters']) | {meta['cluster_id'] for meta, _ in records}
+
+
+def encodings_to_arrays(encodings, dim=128, dtype='float64'):
+    """Flatten a {cluster_id: [encoding, ...]} dict into (matrix, labels, clusters)"""
+    clusters = list(encodings.keys())
+    rows = [np.asarray(enc, dtype=dtype) for v in encodings.values() for enc in v]
+    labels = [idx for idx, v in enumerate(encodings.values()) for _ in v]
+    if rows:
+        matrix = np.vstack(rows)
+    else:
+        matrix = np.empty((0, dim), dtype=dtype)
+    return matrix, np.array(labels, dtype=np.int32), clusters
+
+
+def migrate_json_store(json_path, store_path, dtype='float64'):
+    """One-shot conversion of a legacy encodings.json into the binary store"""
+    try:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        matrix, labels, clusters = encodings_to_arrays(data, dtype=dtype)
+        write_store(store_path, matrix, labels, clusters, dtype=dtype)
+        print(f"Migrated {len(labels)} encodings in {len(clusters)} clusters from {json_path}")
+        return True
+    except Exception as e:
+        print(f"Error migrating encodings: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    import sys
+    from shared_constants import RESULTS_FOLDER, ENCODINGS_FILE
+
+    json_path = sys.argv[1] if len(sys.argv) > 1 else ENCODINGS_FILE
+    store_path = sys.argv[2] if len(sys.argv) > 2 else RESULTS_FOLDER
+    sys.exit(0 if migrate_json_store(json_path, store_path) else 1)
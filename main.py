@@ -1,41 +1,94 @@
 from stages.process_image import process_file
+from stages.pipeline import IngestionPipeline
 
 import face_recognition
 import os
+import time
+import argparse
 from pathlib import Path
-from shutil import copyfile
-from shared_constants import DATASET_FOLDER, RESULTS_FOLDER
-from encodings_manager import EncodingsManager
+from shared_constants import DATASET_FOLDER, RESULTS_FOLDER, ENCODING_CACHE_FILE, MAX_DETECTION_SIDE
+from encodings_manager import EncodingsManager, ANN_MIN_ROWS
+from ann_index import DEFAULT_NPROBE
+from encoding_cache import EncodingCache
 
-def main():
-    encodings_manager = EncodingsManager(RESULTS_FOLDER)
-    dataset_path = Path(DATASET_FOLDER)
-    
-    # Process all images in dataset folder
-    for subdir, dirs, files in os.walk(dataset_path):
-        total = len(files)
-        for idx, file in enumerate(files, 1):
+def collect_files(dataset_path):
+    """All images under dataset_path, sorted so runs assign clusters in a stable order"""
+    files = []
+    for subdir, dirs, filenames in os.walk(dataset_path):
+        for file in filenames:
             if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                filepath = os.path.join(subdir, file)
-                print(f"Processing file {idx}/{total}: {filepath}")
-                
-                try:
-                    # Process the image and get cluster ID
-                    cluster_id = process_file(filepath, encodings_manager)
-                    
-                    if cluster_id:
-                        # Copy file to appropriate cluster directory
-                        cluster_dir = Path(RESULTS_FOLDER) / cluster_id
-                        cluster_dir.mkdir(parents=True, exist_ok=True)
-                        copyfile(filepath, cluster_dir / file)
-                        print(f"Added to cluster: {cluster_id}")
-                    else:
-                        print("No face detected, skipping...")
-                        
-                except Exception as e:
-                    print(f"Error processing {file}: {str(e)}")
-
-    print(f"Processing complete. Found {len(encodings_manager.encodings)} distinct faces.")
+                files.append(os.path.join(subdir, file))
+    return sorted(files)
+
+def handle_result(filepath, cluster_id):
+    # process_file has already linked the image into its cluster folders
+    if cluster_id:
+        print(f"Added to cluster: {cluster_id}")
+    else:
+        print("No face detected, skipping...")
+
+def run_serial(files, encodings_manager, encoding_cache, args):
+    total = len(files)
+    for idx, filepath in enumerate(files, 1):
+        print(f"Processing file {idx}/{total}: {filepath}")
+        try:
+            # Process the image and get cluster ID
+            cluster_id = process_file(filepath, encodings_manager, encoding_cache, args.max_detection_side)
+            handle_result(filepath, cluster_id)
+        except Exception as e:
+            print(f"Error processing {filepath}: {str(e)}")
+
+def run_pipeline(files, encodings_manager, encoding_cache, args):
+    """Streaming ingestion: readers, an encoder process pool, one assigner and file writers"""
+    pipeline = IngestionPipeline(
+        encodings_manager,
+        encoding_cache,
+        workers=args.workers,
+        readers=args.readers,
+        writers=args.writers,
+        queue_size=args.queue_size,
+        max_detection_side=args.max_detection_side
+    )
+    stats = pipeline.run(files)
+    print(f"Clustered {stats['processed']} images, skipped {stats['skipped']}, "
+          f"{stats['no_face']} without faces, {stats['errors']} errors")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster faces in the dataset folder")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes used for face detection and encoding")
+    parser.add_argument('--readers', type=int, default=2,
+                        help="Threads reading images from disk (pipeline mode)")
+    parser.add_argument('--writers', type=int, default=2,
+                        help="Threads copying images into cluster folders (pipeline mode)")
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help="Capacity of each queue between pipeline stages")
+    parser.add_argument('--max-detection-side', type=int, default=MAX_DETECTION_SIDE,
+                        help="Detect faces on a copy downscaled to this many pixels (0 = full resolution)")
+    parser.add_argument('--ann-min-rows', type=int, default=ANN_MIN_ROWS,
+                        help="Search through the approximate index once this many encodings are stored (0 = never)")
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE,
+                        help="Index lists scanned per face when the approximate index is used")
+    args = parser.parse_args()
+
+    encodings_manager = EncodingsManager(RESULTS_FOLDER, ann_min_rows=args.ann_min_rows or None, nprobe=args.nprobe)
+    encoding_cache = EncodingCache(ENCODING_CACHE_FILE)
+    files = collect_files(Path(DATASET_FOLDER))
+
+    start = time.perf_counter()
+    if args.workers > 1:
+        run_pipeline(files, encodings_manager, encoding_cache, args)
+    else:
+        run_serial(files, encodings_manager, encoding_cache, args)
+    elapsed = time.perf_counter() - start
+
+    # Fold this run's journal into a fresh snapshot
+    encodings_manager.save_encodings()
+    print(f"Processing complete. Found {encodings_manager.cluster_count()} distinct faces.")
+    if elapsed > 0:
+        print(f"Processed {len(files)} images in {elapsed:.1f}s ({len(files) / elapsed:.2f} images/sec)")
+    cache_stats = encoding_cache.stats()
+    print(f"Encoding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,124 @@
+import time
+import sqlite3
+import threading
+
+MERGE_CANDIDATES_FILE = 'merge_candidates.db'
+# Faces this far beyond the match tolerance still count as evidence
+NEAR_MISS_MARGIN = 0.1
+FLUSH_EVERY = 500
+FLUSH_SECONDS = 30
+
+
+class MergeCandidates:
+    """Running merge evidence between cluster pairs, collected during ingestion.
+
+    A face inside the tolerance of several clusters, or just outside the
+    tolerance of a cluster, links those clusters. Evidence is buffered in
+    memory and written to SQLite in batches; pairs are stored with the
+    smaller id first.
+    """
+
+    def __init__(self, db_path, tolerance=0.6, margin=NEAR_MISS_MARGIN):
+        self.db_path = str(db_path)
+        self.tolerance = tolerance
+        self.margin = margin
+        self._pending = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS merge_candidates (
+                    cluster_a TEXT NOT NULL,
+                    cluster_b TEXT NOT NULL,
+                    score REAL NOT NULL,
+                    evidence INTEGER NOT NULL,
+                    min_distance REAL NOT NULL,
+                    last_seen REAL NOT NULL,
+                    PRIMARY KEY (cluster_a, cluster_b)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_merge_candidates_score ON merge_candidates (score DESC)')
+
+    def weight(self, distance):
+        """1 inside tolerance, falling linearly to 0 at tolerance + margin"""
+        if distance < self.tolerance:
+            return 1.0
+        return max(0.0, 1.0 - (distance - self.tolerance) / self.margin)
+
+    def record(self, cluster_id, near_clusters):
+        """Record evidence linking cluster_id to each (other_cluster, distance) a face came near"""
+        with self._lock:
+            for other, distance in near_clusters:
+                if other == cluster_id:
+                    continue
+                weight = self.weight(distance)
+                if weight <= 0:
+                    continue
+                key = tuple(sorted((cluster_id, other)))
+                score, evidence, min_distance = self._pending.get(key, (0.0, 0, distance))
+                self._pending[key] = (score + weight, evidence + 1, min(min_distance, distance))
+            flush = len(self._pending) >= FLUSH_EVERY or time.time() - self._last_flush > FLUSH_SECONDS
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Add buffered evidence to the stored scores"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return True
+        try:
+            now = time.time()
+            with sqlite3.connect(self.db_path) as conn:
+                conn.executemany('''
+                    INSERT INTO merge_candidates (cluster_a, cluster_b, score, evidence, min_distance, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (cluster_a, cluster_b) DO UPDATE SET
+                        score = score + excluded.score,
+                        evidence = evidence + excluded.evidence,
+                        min_distance = MIN(min_distance, excluded.min_distance),
+                        last_seen = excluded.last_seen
+                ''', [(a, b, score, evidence, min_distance, now)
+                      for (a, b), (score, evidence, min_distance) in pending.items()])
+            return True
+        except Exception as e:
+            print(f"Error saving merge candidates: {e}")
+            return False
+
+    def top_candidates(self, limit=50, resolve=None):
+        """Highest-scoring pairs as dicts, most evidence first.
+
+        resolve maps a cluster id to its current id; pairs that now resolve to
+        the same cluster are dropped and pairs that now coincide are combined.
+        """
+        self.flush()
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute('''
+                SELECT cluster_a, cluster_b, score, evidence, min_distance
+                FROM merge_candidates ORDER BY score DESC LIMIT ?
+            ''', (limit * 4 if resolve else limit,)).fetchall()
+
+        pairs = {}
+        for cluster_a, cluster_b, score, evidence, min_distance in rows:
+            if resolve:
+                cluster_a, cluster_b = resolve(cluster_a), resolve(cluster_b)
+                if cluster_a == cluster_b:
+                    continue
+            key = tuple(sorted((cluster_a, cluster_b)))
+            if key in pairs:
+                pairs[key]['score'] += score
+                pairs[key]['evidence'] += evidence
+                pairs[key]['min_distance'] = min(pairs[key]['min_distance'], min_distance)
+            else:
+                pairs[key] = {
+                    'cluster1': key[0],
+                    'cluster2': key[1],
+                    'score': score,
+                    'evidence': evidence,
+                    'min_distance': min_distance
+                }
+        return sorted(pairs.values(), key=lambda p: -p['score'])[:limit]
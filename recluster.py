@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from shared_constants import RESULTS_FOLDER
+from encodings_manager import EncodingsManager
+from cluster_similarity import pairwise_distances
+
+RECLUSTER_FOLDER = 'recluster'
+KNN_NEIGHBOURS = 10
+KNN_MEMORY_MB = 256
+WHISPERS_ITERATIONS = 20
+
+
+def knn_rows(matrix, start, stop, k, threshold, memory_mb=KNN_MEMORY_MB):
+    """Edges (src, dst, distance) from rows start:stop to their k nearest rows within threshold.
+
+    The distance matrix is computed in (row block x column block) tiles sized
+    to memory_mb, keeping a running top-k per row.
+    """
+    count = len(matrix)
+    k = min(k, count - 1)
+    if k <= 0 or start >= stop:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    tile = int(max(64, np.sqrt(memory_mb * 1024 * 1024 / (8 * 3))))
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    sources, targets, distances = [], [], []
+
+    for row_start in range(start, stop, tile):
+        rows = np.arange(row_start, min(row_start + tile, stop))
+        a = np.asarray(matrix[rows], dtype=np.float64)
+        best_d = np.full((len(rows), k), np.inf)
+        best_i = np.full((len(rows), k), -1, dtype=np.int64)
+        for col_start in range(0, count, tile):
+            cols = np.arange(col_start, min(col_start + tile, count))
+            d = pairwise_distances(a, matrix[cols], sq_norms[rows], sq_norms[cols])
+            # A row is not its own neighbour
+            overlap = np.nonzero((rows[:, None] == cols[None, :]))
+            d[overlap] = np.inf
+            merged_d = np.hstack((best_d, d))
+            merged_i = np.hstack((best_i, np.broadcast_to(cols, d.shape)))
+            keep = np.argpartition(merged_d, k - 1, axis=1)[:, :k]
+            best_d = np.take_along_axis(merged_d, keep, axis=1)
+            best_i = np.take_along_axis(merged_i, keep, axis=1)
+
+        within = best_d <= threshold
+        sources.append(np.broadcast_to(rows[:, None], best_d.shape)[within])
+        targets.append(best_i[within])
+        distances.append(best_d[within])
+
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(distances)
+
+
+def _knn_worker(matrix_path, start, stop, k, threshold, memory_mb):
+    # Each worker maps the same matrix, sharing it through the page cache
+    matrix = np.load(matrix_path, mmap_mode='r')
+    return knn_rows(matrix, start, stop, k, threshold, memory_mb)
+
+
+def knn_graph(matrix, k=KNN_NEIGHBOURS, threshold=0.6, workers=1, temp_path=None, memory_mb=KNN_MEMORY_MB):
+    """Undirected thresholded kNN graph as unique (src, dst, distance) edges with src < dst.
+
+    With workers > 1 the matrix is written to a temporary .npy in temp_path
+    for the worker processes to map; the encodings store is never written.
+    """
+    count = len(matrix)
+    if workers > 1 and temp_path:
+        os.makedirs(temp_path, exist_ok=True)
+        fd, matrix_path = tempfile.mkstemp(suffix='.npy', dir=temp_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(matrix))
+            bounds = np.linspace(0, count, workers * 4 + 1).astype(int)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(
+                    _knn_worker,
+                    [matrix_path] * (len(bounds) - 1), bounds[:-1], bounds[1:],
+                    [k] * (len(bounds) - 1), [threshold] * (len(bounds) - 1), [memory_mb] * (len(bounds) - 1)
+                ))
+        finally:
+            os.remove(matrix_path)
+    else:
+        parts = [knn_rows(matrix, 0, count, k, threshold, memory_mb)]
+
+    src = np.concatenate([p[0] for p in parts])
+    dst = np.concatenate([p[1] for p in parts])
+    dist = np.concatenate([p[2] for p in parts])
+    # An edge may be found from both ends; keep one copy
+    lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+    _, unique = np.unique(lo * count + hi, return_index=True)
+    return lo[unique], hi[unique], dist[unique]
+
+
+def connected_components(count, src, dst):
+    """Component label per node, by min-label propagation with pointer jumping"""
+    labels = np.arange(count)
+    while True:
+        previous = labels.copy()
+        low = np.minimum(labels[src], labels[dst])
+        np.minimum.at(labels, src, low)
+        np.minimum.at(labels, dst, low)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return np.unique(labels, return_inverse=True)[1]
+
+
+def chinese_whispers(count, src, dst, weights, iterations=WHISPERS_ITERATIONS, seed=0):
+    """Chinese Whispers: each node repeatedly takes the label with the most edge weight among its neighbours"""
+    # Adjacency in CSR form, both directions
+    nodes = np.concatenate((src, dst))
+    neighbours = np.concatenate((dst, src))
+    edge_weights = np.concatenate((weights, weights))
+    order = np.argsort(nodes, kind='stable')
+    neighbours, edge_weights = neighbours[order].tolist(), edge_weights[order].tolist()
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(nodes, minlength=count)))).tolist()
+
+    labels = list(range(count))
+    rng = np.random.default_rng(seed)
+    for _ in range(iterations):
+        changed = 0
+        for node in rng.permutation(count).tolist():
+            start, stop = indptr[node], indptr[node + 1]
+            if start == stop:
+                continue
+            scores = {}
+            for neighbour, weight in zip(neighbours[start:stop], edge_weights[start:stop]):
+                label = labels[neighbour]
+                scores[label] = scores.get(label, 0.0) + weight
+            best = max(scores, key=scores.get)
+            if best != labels[node]:
+                labels[node] = best
+                changed += 1
+        if changed == 0:
+            break
+    return np.unique(np.asarray(labels), return_inverse=True)[1]
+
+
+def name_clusters(old_labels, new_labels, old_clusters, is_used=None):
+    """Give each new cluster the old cluster_id it shares most faces with, or a fresh cluster_<n>.
+
+    Old ids are handed out largest overlap first and at most once, so an
+    unchanged cluster keeps its id and a split keeps it on its larger part.
+    Fresh names also skip every id is_used reports (e.g. merged or renamed
+    ids that would resolve to another cluster).
+    """
+    new_count = int(new_labels.max()) + 1 if len(new_labels) else 0
+    pairs, overlap = np.unique(
+        np.stack((new_labels, old_labels), axis=1), axis=0, return_counts=True
+    ) if len(new_labels) else (np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64))
+
+    names = [None] * new_count
+    taken = set()
+    for idx in np.argsort(-overlap, kind='stable'):
+        new, old = int(pairs[idx][0]), int(pairs[idx][1])
+        if names[new] is None and old not in taken:
+            names[new] = old_clusters[old]
+            taken.add(old)
+
+    used = set(old_clusters)
+    n = len(old_clusters) + 1
+    for new in range(new_count):
+        if names[new] is None:
+            while f"cluster_{n}" in used or (is_used and is_used(f"cluster_{n}")):
+                n += 1
+            names[new] = f"cluster_{n}"
+            used.add(names[new])
+    return names
+
+
+def canonical_labels(encodings_manager):
+    """Stored row labels and cluster ids with merged and renamed clusters resolved, in memory only"""
+    canonical = [encodings_manager.identity.find(cluster_id) for cluster_id in encodings_manager.clusters]
+    clusters = list(dict.fromkeys(canonical))
+    index = {cluster_id: idx for idx, cluster_id in enumerate(clusters)}
+    remap = np.array([index[cluster_id] for cluster_id in canonical], dtype=np.int32)
+    return remap[encodings_manager.labels], clusters
+
+
+def assignment_diff(encodings_manager, old_labels, old_clusters, new_labels, new_clusters):
+    """Summary of how the new assignment differs from the stored one (old_labels over old_clusters)"""
+    old_names = np.asarray(old_clusters, dtype=object)[old_labels]
+    new_names = np.asarray(new_clusters, dtype=object)[new_labels]
+
+    # Distinct (new, old) label pairs: a new cluster drawing on several old
+    # ones is a merge, an old cluster spread over several new ones a split
+    pairs = np.unique(np.stack((new_labels, old_labels), axis=1), axis=0) if len(old_labels) else []
+    merged, split = {}, {}
+    for new, old in pairs:
+        merged.setdefault(new_clusters[new], []).append(old_clusters[old])
+        split.setdefault(old_clusters[old], []).append(new_clusters[new])
+    merged = {new: sorted(olds) for new, olds in merged.items() if len(olds) > 1}
+    split = {old: sorted(news) for old, news in split.items() if len(news) > 1}
+
+    moved = np.nonzero(old_names != new_names)[0]
+    images = encodings_manager.images
+    image_ids = encodings_manager.image_ids
+    return {
+        'faces': int(len(old_labels)),
+        'old_clusters': len(old_clusters),
+        'new_clusters': len(new_clusters),
+        'moved_faces': int(len(moved)),
+        'merged': merged,
+        'split': split,
+        'moves': [
+            {
+                'row': int(row),
+                'image': images[image_ids[row]] if image_ids[row] >= 0 else None,
+                'from': old_names[row],
+                'to': new_names[row]
+            }
+            for row in moved
+        ]
+    }
+
+
+def recluster(results_path, method='whispers', threshold=0.6, k=KNN_NEIGHBOURS, workers=1,
+              iterations=WHISPERS_ITERATIONS, memory_mb=KNN_MEMORY_MB):
+    """Cluster every stored encoding from scratch and write the assignment and diff.
+
+    The snapshot and journal are only read, so this can run next to the app
+    and the worker; nothing in the store or the cluster folders is changed.
+    Returns the folder the results were written to, or None on failure.
+    """
+    try:
+        encodings_manager = EncodingsManager(results_path, ann_min_rows=None)
+        old_labels, old_clusters = canonical_labels(encodings_manager)
+        matrix = encodings_manager.matrix
+        count = len(matrix)
+        print(f"Re-clustering {count} encodings from {len(old_clusters)} clusters")
+
+        start = time.perf_counter()
+        src, dst, dist = knn_graph(
+            matrix, k, threshold, workers, os.path.join(results_path, RECLUSTER_FOLDER), memory_mb
+        )
+        print(f"Built {len(src)} edge kNN graph in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        if method == 'components':
+            new_labels = connected_components(count, src, dst)
+        else:
+            # Closer pairs vote more strongly
+            new_labels = chinese_whispers(count, src, dst, 1.0 - dist / (threshold * 2), iterations)
+        new_clusters = name_clusters(old_labels, new_labels, old_clusters, encodings_manager.cluster_id_used)
+        print(f"Found {len(new_clusters)} clusters in {time.perf_counter() - start:.1f}s")
+
+        diff = assignment_diff(encodings_manager, old_labels, old_clusters, new_labels, new_clusters)
+        out_path = os.path.join(results_path, RECLUSTER_FOLDER, time.strftime('%Y%m%d_%H%M%S'))
+        while os.path.exists(out_path):
+            out_path += '_1'
+        os.makedirs(out_path)
+        np.save(os.path.join(out_path, 'labels.npy'), new_labels.astype(np.int32))
+        with open(os.path.join(out_path, 'clusters.json'), 'w') as f:
+            json.dump(new_clusters, f)
+        with open(os.path.join(out_path, 'diff.json'), 'w') as f:
+            json.dump(diff, f, indent=2)
+        encodings_manager.close()
+
+        print(f"{diff['moved_faces']} faces change cluster: {len(diff['merged'])} merges, "
+              f"{len(diff['split'])} splits")
+        print(f"Assignment and diff written to {out_path}")
+        return out_path
+    except Exception as e:
+        print(f"Error re-clustering encodings: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-cluster all stored encodings without touching images")
+    parser.add_argument('results', nargs='?', default=RESULTS_FOLDER)
+    parser.add_argument('--method', choices=['whispers', 'components'], default='whispers',
+                        help="Chinese Whispers, or connected components of the kNN graph")
+    parser.add_argument('--threshold', type=float, default=0.6, help="Largest distance joined by an edge")
+    parser.add_argument('--neighbours', type=int, default=KNN_NEIGHBOURS, help="Edges kept per face")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Processes building the kNN graph")
+    parser.add_argument('--iterations', type=int, default=WHISPERS_ITERATIONS)
+    parser.add_argument('--memory-mb', type=int, default=KNN_MEMORY_MB,
+                        help="Distance tile size per process")
+    args = parser.parse_args()
+    out_path = recluster(args.results, args.method, args.threshold, args.neighbours, args.workers,
+                         args.iterations, args.memory_mb)
+    raise SystemExit(0 if out_path else 1)
@@ -8,6 +8,10 @@ BASE_DIR = Path(__file__).parent.absolute()
 DATASET_FOLDER = os.path.join(BASE_DIR, 'dataset')
 RESULTS_FOLDER = os.path.join(BASE_DIR, 'results')
 ENCODINGS_FILE = os.path.join(RESULTS_FOLDER, 'encodings.json')
+ENCODING_CACHE_FILE = os.path.join(RESULTS_FOLDER, 'encoding_cache.db')
+
+# Longest side, in pixels, of the copy faces are detected on (0 = full resolution)
+MAX_DETECTION_SIDE = 1600
 
 # Create necessary directories
 os.makedirs(DATASET_FOLDER, exist_ok=True)
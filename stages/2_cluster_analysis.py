@@ -2,8 +2,26 @@ import streamlit as st
 from pathlib import Path
 import face_recognition
 import numpy as np
-from shared_constants import RESULTS_FOLDER
-from utils.core import move_image_to_cluster, delete_cluster
+from shared_constants import RESULTS_FOLDER, ENCODING_CACHE_FILE
+from encodings_manager import EncodingsManager
+from cluster_identity import get_cluster_identity
+from database import Database
+from catalog import get_catalog
+from encoding_cache import EncodingCache
+from stages.process_image import detect_and_encode, primary_face_index
+from cluster_similarity import cluster_similarity, similar_cluster_pairs, pairwise_distances, SIMILARITY_MEMORY_MB
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def get_encodings_manager():
+    """The session's EncodingsManager, created on first use"""
+    if 'encodings_manager' not in st.session_state:
+        st.session_state.encodings_manager = EncodingsManager(RESULTS_FOLDER)
+    return st.session_state.encodings_manager
+
+def cluster_images(cluster_path):
+    """Image files in a cluster folder, any extension case"""
+    return sorted(p for p in Path(cluster_path).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
 
 def analyze_clusters():
     """Analyze existing clusters for potential merging opportunities"""
@@ -14,26 +32,58 @@ def analyze_clusters():
         st.error("Results folder not found")
         return
         
-    clusters = [c for c in clusters_path.glob('cluster_*') if c.is_dir()]
+    # Folders of merged clusters wait for their files to be moved; skip them
+    identity = get_cluster_identity(RESULTS_FOLDER)
+    clusters = [c for c in clusters_path.glob('cluster_*') if c.is_dir() and identity.is_canonical(c.name)]
     if not clusters:
         st.info("No clusters found for analysis")
         return
+    
+    # Evidence recorded while images were ingested; nothing to compute here
+    st.subheader("Merge Candidates from Ingestion")
+    candidates = get_encodings_manager().merge_candidates.top_candidates(resolve=identity.find)
+    if candidates:
+        for pair in candidates:
+            with st.expander(f"Evidence: {pair['cluster1']} ↔️ {pair['cluster2']}"):
+                st.write(f"Score: {pair['score']:.2f} from {pair['evidence']} faces")
+                st.write(f"Closest Distance: {pair['min_distance']:.3f}")
+                show_pair_actions(pair['cluster1'], pair['cluster2'], 'candidate')
+    else:
+        st.info("No merge candidates recorded yet")
         
     st.subheader("Cluster Similarity Analysis")
+    if not st.checkbox("Run full similarity scan"):
+        return
     
     # Analyze each cluster pair
     with st.spinner("Analyzing clusters..."):
         similar_clusters = []
         
-        for i, cluster1 in enumerate(clusters):
-            for cluster2 in clusters[i+1:]:
-                similarity = compare_clusters(cluster1, cluster2)
-                if similarity['score'] > 0.7:  # High similarity threshold
-                    similar_clusters.append({
-                        'cluster1': cluster1.name,
-                        'cluster2': cluster2.name,
-                        'similarity': similarity
-                    })
+        # Encodings are gathered once per cluster, not once per pair
+        encodings_manager = get_encodings_manager()
+        encoding_cache = EncodingCache(ENCODING_CACHE_FILE)
+        cluster_encodings = {
+            cluster.name: get_cluster_encodings(cluster, encodings_manager, encoding_cache)
+            for cluster in clusters
+        }
+        
+        # One blocked all-pairs pass gives every cluster pair's similarity
+        similarity = get_similarity_matrix(cluster_encodings)
+        names = list(cluster_encodings)
+        sizes = similarity['sizes']
+        
+        for i, j in similar_cluster_pairs(similarity, threshold=0.7):  # High similarity threshold
+            similar_clusters.append({
+                'cluster1': names[i],
+                'cluster2': names[j],
+                'similarity': {
+                    'score': float(similarity['match_fraction'][i, j]),
+                    'matching_faces': int(similarity['matches'][i, j]),
+                    'total_faces': (int(sizes[i]), int(sizes[j])),
+                    'min_distance': float(similarity['min'][i, j]),
+                    'mean_distance': float(similarity['mean'][i, j])
+                }
+            })
         
         if similar_clusters:
             st.warning(f"Found {len(similar_clusters)} potential cluster pairs that could be merged")
@@ -42,56 +92,72 @@ def analyze_clusters():
                 with st.expander(f"Similarity: {pair['cluster1']} ↔️ {pair['cluster2']}"):
                     st.write(f"Similarity Score: {pair['similarity']['score']:.2f}")
                     st.write(f"Matching Faces: {pair['similarity']['matching_faces']}")
-                    
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        if st.button(f"Merge {pair['cluster1']} → {pair['cluster2']}", 
-                                   key=f"merge_{pair['cluster1']}_{pair['cluster2']}"):
-                            merge_clusters(pair['cluster1'], pair['cluster2'])
-                            st.success("Clusters merged successfully!")
-                            st.experimental_rerun()
-                    
-                    with col2:
-                        if st.button("View Details", key=f"details_{pair['cluster1']}_{pair['cluster2']}"):
-                            show_cluster_comparison(pair['cluster1'], pair['cluster2'])
+                    st.write(f"Closest / Mean Distance: {pair['similarity']['min_distance']:.3f} / "
+                             f"{pair['similarity']['mean_distance']:.3f}")
+                    show_pair_actions(pair['cluster1'], pair['cluster2'], 'scan')
         else:
             st.success("No highly similar clusters found")
 
+def show_pair_actions(cluster1, cluster2, key_prefix):
+    """Merge and details buttons for a suggested cluster pair"""
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button(f"Merge {cluster1} → {cluster2}", 
+                   key=f"{key_prefix}_merge_{cluster1}_{cluster2}"):
+            if merge_clusters(cluster1, cluster2):
+                st.success("Clusters merged successfully!")
+                st.experimental_rerun()
+    
+    with col2:
+        if st.button("View Details", key=f"{key_prefix}_details_{cluster1}_{cluster2}"):
+            show_cluster_comparison(cluster1, cluster2)
+
+def get_similarity_matrix(cluster_encodings, memory_mb=SIMILARITY_MEMORY_MB):
+    """K x K similarity matrices for {cluster_name: [encoding, ...]}, in the dict's order"""
+    labels = np.repeat(np.arange(len(cluster_encodings)), [len(v) for v in cluster_encodings.values()])
+    rows = [enc for v in cluster_encodings.values() for enc in v]
+    matrix = np.vstack(rows) if rows else np.empty((0, 128))
+    return cluster_similarity(matrix, labels, len(cluster_encodings), tolerance=0.6, memory_mb=memory_mb)
+
 def merge_clusters(source_cluster, target_cluster):
-    """Merge source cluster into target cluster"""
+    """Merge source cluster into target cluster.
+
+    Only the cluster identity, the catalog and the requests table change
+    here; stored encodings resolve to the target on read and the image files
+    are moved in the background.
+    """
     try:
-        source_path = Path(RESULTS_FOLDER) / source_cluster
-        
-        # Move all images from source to target
-        for img_path in source_path.glob('*.{jpg,jpeg,png,JPG,JPEG,PNG}'):
-            move_image_to_cluster(source_cluster, target_cluster, img_path.name)
+        identity = get_cluster_identity(RESULTS_FOLDER)
+        source = identity.find(source_cluster)
+        success, message = identity.merge(source_cluster, target_cluster)
+        if not success:
+            st.error(message)
+            return False
         
-        # Delete source cluster
-        delete_cluster(source_cluster)
+        get_catalog().merge_clusters(source, identity.find(target_cluster))
+        Database().reassign_cluster(source_cluster, identity.find(target_cluster))
+        identity.start_background_moves()
         return True
         
     except Exception as e:
         st.error(f"Error merging clusters: {str(e)}")
         return False
 
-def compare_clusters(cluster1_path, cluster2_path):
+def compare_clusters(cluster1_path, cluster2_path, encodings1=None, encodings2=None):
     """Compare two clusters and return similarity metrics"""
     try:
-        # Get face encodings from both clusters
-        encodings1 = get_cluster_encodings(cluster1_path)
-        encodings2 = get_cluster_encodings(cluster2_path)
+        # Get face encodings from both clusters unless the caller already has them
+        if encodings1 is None:
+            encodings1 = get_cluster_encodings(cluster1_path, get_encodings_manager())
+        if encodings2 is None:
+            encodings2 = get_cluster_encodings(cluster2_path, get_encodings_manager())
         
         if not encodings1 or not encodings2:
             return {'score': 0, 'matching_faces': 0}
             
-        # Compare each face encoding
-        matches = 0
+        # Compare every face encoding pair at once
         total_comparisons = len(encodings1) * len(encodings2)
-        
-        for enc1 in encodings1:
-            for enc2 in encodings2:
-                if face_recognition.compare_faces([enc1], enc2, tolerance=0.6)[0]:
-                    matches += 1
+        matches = int((pairwise_distances(encodings1, encodings2) <= 0.6).sum())
                     
         similarity_score = matches / total_comparisons if total_comparisons > 0 else 0
         
@@ -105,16 +171,41 @@ def compare_clusters(cluster1_path, cluster2_path):
         print(f"Error comparing clusters: {str(e)}")
         return {'score': 0, 'matching_faces': 0, 'total_faces': (0, 0)}
 
-def get_cluster_encodings(cluster_path):
-    """Get face encodings for all images in a cluster"""
-    encodings = []
+def get_cluster_encodings(cluster_path, encodings_manager, encoding_cache=None):
+    """Get face encodings for all images in a cluster.
+
+    Encodings come from the EncodingsManager face records, then from the
+    encoding cache; faces are only detected again for images found in neither.
+    """
+    cluster_id = Path(cluster_path).name
     
-    for img_path in cluster_path.glob('*.{jpg,jpeg,png,JPG,JPEG,PNG}'):
+    # Stores converted from encodings.json have no per-image records; use the
+    # rows labelled with this cluster instead of re-encoding its images
+    rows = encodings_manager.cluster_rows(cluster_id)
+    if len(rows) and (encodings_manager.image_ids[rows] < 0).all():
+        return list(encodings_manager.matrix[rows])
+    
+    encodings = []
+    for img_path in cluster_images(cluster_path):
         try:
-            image = face_recognition.load_image_file(str(img_path))
-            face_encodings = face_recognition.face_encodings(image)
+            faces = encodings_manager.faces_in_image(img_path.name)
+            if faces:
+                # Faces assigned to this cluster; an image moved here by hand keeps its main face
+                members = [f for f in faces if f['cluster_id'] == cluster_id]
+                if not members:
+                    members = [faces[primary_face_index([f['box'] for f in faces])]]
+                encodings.extend(encodings_manager.matrix[f['row']] for f in members)
+                continue
+            
+            cached = encoding_cache.lookup(img_path) if encoding_cache else None
+            if cached and cached['encodings'] is not None:
+                locations, face_encodings = cached['locations'], cached['encodings']
+            else:
+                locations, face_encodings = detect_and_encode(str(img_path))
+                if cached:
+                    encoding_cache.store(cached['hash'], locations, face_encodings)
             if face_encodings:
-                encodings.append(face_encodings[0])
+                encodings.append(face_encodings[primary_face_index(locations)])
         except Exception as e:
             print(f"Error processing {img_path}: {str(e)}")
             
@@ -139,7 +230,7 @@ def show_cluster_comparison(cluster1_id, cluster2_id):
 def show_cluster_images(cluster_path):
     """Display images from a cluster"""
     images = []
-    for img_path in cluster_path.glob('*.{jpg,jpeg,png,JPG,JPEG,PNG}'):
+    for img_path in cluster_images(cluster_path):
         try:
             img = face_recognition.load_image_file(str(img_path))
             images.append((img_path.name, img))
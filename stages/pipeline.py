@@ -0,0 +1,175 @@
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from shared_constants import MAX_DETECTION_SIDE
+from stages.process_image import encode_file, assign_faces, store_image, primary_face_index
+
+_DONE = object()
+
+class IngestionPipeline:
+    """Streaming ingestion: read -> detect/encode -> assign -> persist.
+
+    Stages are connected by bounded queues and a window of in-flight images,
+    so disk reads, CPU encoding and file copies overlap while memory stays
+    bounded. Only the single assigner thread touches the EncodingsManager and
+    it handles images in input order, so the clustering is deterministic.
+    """
+
+    def __init__(self, encodings_manager, encoding_cache, workers=4, readers=2, writers=2, queue_size=16,
+                 max_detection_side=MAX_DETECTION_SIDE):
+        self.encodings_manager = encodings_manager
+        self.encoding_cache = encoding_cache
+        self.workers = max(1, workers)
+        self.readers = max(1, readers)
+        self.writers = max(1, writers)
+        self.queue_size = max(1, queue_size)
+        self.max_detection_side = max_detection_side
+        self.stats = {'processed': 0, 'skipped': 0, 'no_face': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def run(self, files):
+        """Ingest files and return the stage counters"""
+        file_q = queue.Queue()
+        for item in enumerate(files):
+            file_q.put(item)
+
+        read_q = queue.Queue(maxsize=self.queue_size)
+        encoded_q = queue.Queue(maxsize=self.queue_size)
+        persist_q = queue.Queue(maxsize=self.queue_size)
+        # Caps images between the readers and the assigner, including ones
+        # waiting to be put back in order
+        window = threading.Semaphore(self.queue_size + self.workers * 2)
+        self.total = len(files)
+
+        # Pool workers are started from the dispatcher thread while other
+        # threads may hold locks, so they are spawned rather than forked
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as executor:
+            readers = [
+                threading.Thread(target=self._read, args=(file_q, read_q, window), daemon=True)
+                for _ in range(self.readers)
+            ]
+            dispatcher = threading.Thread(target=self._dispatch, args=(read_q, encoded_q, executor), daemon=True)
+            writers = [
+                threading.Thread(target=self._persist, args=(persist_q,), daemon=True)
+                for _ in range(self.writers)
+            ]
+            for thread in readers + [dispatcher] + writers:
+                thread.start()
+
+            # The assigner runs on the calling thread
+            self._assign(encoded_q, persist_q, window)
+
+            for thread in readers:
+                thread.join()
+            read_q.put(_DONE)
+            dispatcher.join()
+            for _ in writers:
+                persist_q.put(_DONE)
+            for thread in writers:
+                thread.join()
+
+        return self.stats
+
+    def _read(self, file_q, read_q, window):
+        while True:
+            window.acquire()
+            try:
+                idx, filepath = file_q.get_nowait()
+            except queue.Empty:
+                window.release()
+                return
+
+            data, cached, error = None, None, None
+            try:
+                if self.encoding_cache:
+                    cached = self.encoding_cache.lookup(filepath)
+                if not (cached and cached['encodings'] is not None):
+                    with open(filepath, 'rb') as f:
+                        data = f.read()
+            except Exception as e:
+                error = str(e)
+            read_q.put((idx, filepath, data, cached, error))
+
+    def _dispatch(self, read_q, encoded_q, executor):
+        while True:
+            item = read_q.get()
+            if item is _DONE:
+                encoded_q.put(_DONE)
+                return
+            idx, filepath, data, cached, error = item
+            future = None
+            if data is not None and not error:
+                try:
+                    future = executor.submit(encode_file, filepath, data, self.max_detection_side)
+                except Exception as e:
+                    # e.g. BrokenProcessPool after a worker died; the image is
+                    # still passed on so the assigner does not wait for it
+                    error = str(e)
+            encoded_q.put((idx, filepath, cached, future, error))
+
+    def _assign(self, encoded_q, persist_q, window):
+        # Items arrive out of order from parallel readers; buffer until the next index is available
+        buffered = {}
+        next_idx = 0
+        while next_idx < self.total:
+            item = encoded_q.get()
+            if item is _DONE:
+                break
+            buffered[item[0]] = item
+            while next_idx in buffered:
+                self._assign_one(*buffered.pop(next_idx), persist_q)
+                window.release()
+                next_idx += 1
+
+    def _assign_one(self, idx, filepath, cached, future, error, persist_q):
+        print(f"Processing file {idx + 1}/{self.total}: {filepath}")
+        try:
+            if error:
+                raise Exception(error)
+
+            if cached and cached['cluster_id'] and self.encodings_manager.has_cluster(cached['cluster_id']):
+                print(f"Already clustered in {cached['cluster_id']}, skipping")
+                self._count('skipped')
+                return
+
+            if future is None:
+                locations, fe = cached['locations'], cached['encodings']
+            else:
+                _, locations, fe, error = future.result()
+                if error:
+                    raise Exception(error)
+
+            cluster_ids = assign_faces(filepath, locations, fe, self.encodings_manager)
+            if not cluster_ids:
+                self._count('no_face')
+            persist_q.put((filepath, cluster_ids, cached, locations, fe, future is not None))
+        except Exception as e:
+            print(f"Error processing {filepath}: {str(e)}")
+            self._count('errors')
+
+    def _persist(self, persist_q):
+        while True:
+            item = persist_q.get()
+            if item is _DONE:
+                return
+            filepath, cluster_ids, cached, locations, fe, computed = item
+            try:
+                cluster_id = None
+                if cluster_ids:
+                    store_image(filepath, cluster_ids, cached['hash'] if cached else None, locations)
+                    cluster_id = cluster_ids[primary_face_index(locations)]
+                    self._count('processed')
+                # Recorded after the copy so a failed copy is retried next run
+                if cached and computed:
+                    self.encoding_cache.store(cached['hash'], locations, fe, cluster_id)
+                elif cached and cluster_id:
+                    self.encoding_cache.mark_assigned(cached['hash'], cluster_id)
+            except Exception as e:
+                print(f"Error persisting {filepath}: {str(e)}")
+                self._count('errors')
@@ -1,63 +1,180 @@
 import face_recognition
+import io
 import os
+import numpy as np
 from pathlib import Path
-from shutil import copyfile
-from utils import save_encodings
-from shared_constants import RESULTS_FOLDER
+from PIL import Image
+from shared_constants import RESULTS_FOLDER, MAX_DETECTION_SIDE
+from blob_store import put_blob, link_blob
+from catalog import get_catalog
         
 cwd = os.getcwd()
 results_path = os.path.join(cwd, 'results')
 encodings = {}
 
-def process_file(filepath, encodings_manager):
+def load_detection_image(source, max_side):
+    """Decode a downscaled copy of the image for face detection.
+
+    Returns (image, x_scale, y_scale), or (None, 1.0, 1.0) when the image is
+    already small enough. JPEGs are decoded directly at reduced size.
+    """
+    with Image.open(source) as im:
+        width, height = im.size
+        scale = max_side / max(width, height) if max_side else 1.0
+        if scale >= 1.0:
+            return None, 1.0, 1.0
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if im.format == 'JPEG':
+            # Scaled DCT decoding picks the smallest 1/2, 1/4 or 1/8 size still >= target
+            im.draft('RGB', target)
+        im = im.convert('RGB')
+        if im.size != target:
+            im = im.resize(target, Image.BILINEAR)
+        return np.array(im), target[0] / width, target[1] / height
+
+def scale_locations(locations, x_scale, y_scale, shape):
+    """Map (top, right, bottom, left) boxes from the detection image back to full resolution"""
+    height, width = shape[:2]
+    return [
+        (
+            max(0, int(round(top / y_scale))),
+            min(width, int(round(right / x_scale))),
+            min(height, int(round(bottom / y_scale))),
+            max(0, int(round(left / x_scale)))
+        )
+        for top, right, bottom, left in locations
+    ]
+
+def detect_and_encode(source, max_detection_side=MAX_DETECTION_SIDE):
+    """Load an image and return (face_locations, face_encodings).
+
+    Faces are detected on a copy no larger than max_detection_side pixels and
+    encoded on the full-resolution image.
+    """
+    detection_img, x_scale, y_scale = load_detection_image(source, max_detection_side)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    img = face_recognition.load_image_file(source)
+    
+    if detection_img is None:
+        locations = face_recognition.face_locations(img)
+    else:
+        locations = scale_locations(face_recognition.face_locations(detection_img), x_scale, y_scale, img.shape)
+    return locations, face_recognition.face_encodings(img, locations)
+
+def encode_file(filepath, data=None, max_detection_side=MAX_DETECTION_SIDE):
+    """Process pool entry point: returns (filepath, locations, encodings, error).
+
+    data holds the file contents when they were already read by the caller.
+    """
+    try:
+        source = io.BytesIO(data) if data is not None else filepath
+        locations, fe = detect_and_encode(source, max_detection_side)
+        return filepath, locations, fe, None
+    except Exception as e:
+        return filepath, None, None, str(e)
+
+def process_file(filepath, encodings_manager, encoding_cache=None, max_detection_side=MAX_DETECTION_SIDE):
     try:
         print(f"Processing file: {filepath}")
-        img = face_recognition.load_image_file(filepath)
-        fe = face_recognition.face_encodings(img)
+        cached = encoding_cache.lookup(filepath) if encoding_cache else None
+        
+        if cached and cached['cluster_id'] and encodings_manager.has_cluster(cached['cluster_id']):
+            print(f"Already clustered in {cached['cluster_id']}, skipping")
+            return cached['cluster_id']
+        
+        if cached and cached['encodings'] is not None:
+            locations, fe = cached['locations'], cached['encodings']
+        else:
+            locations, fe = detect_and_encode(filepath, max_detection_side)
+            if cached:
+                encoding_cache.store(cached['hash'], locations, fe)
         
-        if not fe:
-            print("No face detected in image")
+        return assign_encodings(filepath, locations, fe, encodings_manager, encoding_cache, cached)
+        
+    except Exception as e:
+        print(f"Error processing file {filepath}: {str(e)}")
+        return None
+
+def assign_encodings(filepath, locations, fe, encodings_manager, encoding_cache=None, cached=None):
+    """Assign every face to a cluster and store the image once for all of them.
+
+    Returns the cluster of the largest face in the image.
+    """
+    try:
+        cluster_ids = assign_faces(filepath, locations, fe, encodings_manager)
+        if not cluster_ids:
             return None
-            
-        fe = fe[0]
-        action_taken = False
-        curr_image_cluster_id = None
-        tolerance = 0.6
-        
-        for cluster_id, cluster_encodings in encodings_manager.encodings.items():
-            for encoding in cluster_encodings:
-                distance = face_recognition.face_distance([encoding], fe)[0]
-                if distance < tolerance:
-                    print(f"Match found in cluster {cluster_id} with distance {distance}")
-                    curr_image_cluster_id = cluster_id
-                    encodings_manager.encodings[cluster_id].append(fe)
-                    action_taken = True
-                    break
-            if action_taken:
-                break
-                
-        if not action_taken:
-            curr_image_cluster_id = f"cluster_{len(encodings_manager.encodings.keys()) + 1}"
-            print(f"Creating new cluster {curr_image_cluster_id}")
-            encodings_manager.encodings[curr_image_cluster_id] = [fe]
+        store_image(filepath, cluster_ids, cached['hash'] if cached else None, locations)
         
-        # Use RESULTS_FOLDER instead of results_path
-        cluster_dir = Path(RESULTS_FOLDER) / curr_image_cluster_id
-        cluster_dir.mkdir(exist_ok=True, parents=True)
-        print(f"Created/verified cluster directory: {cluster_dir}")
-        
-        # Copy image to cluster directory
-        dest_path = cluster_dir / Path(filepath).name
-        print(f"About to copy file:")
-        print(f"Source exists: {Path(filepath).exists()}")
-        print(f"Source path: {filepath}")
-        print(f"Destination path: {dest_path}")
-        copyfile(filepath, dest_path)
-        print(f"File copied successfully. Destination exists: {dest_path.exists()}")
-        
-        encodings_manager.save_encodings()
+        curr_image_cluster_id = cluster_ids[primary_face_index(locations)]
+        if cached:
+            encoding_cache.mark_assigned(cached['hash'], curr_image_cluster_id)
         return curr_image_cluster_id
         
     except Exception as e:
         print(f"Error processing file {filepath}: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+def primary_face_index(locations):
+    """Index of the largest (top, right, bottom, left) box"""
+    areas = [(bottom - top) * (right - left) for top, right, bottom, left in locations]
+    return areas.index(max(areas))
+
+def assign_faces(filepath, locations, fe, encodings_manager):
+    """Pick a cluster for each face and record it; touches only the EncodingsManager.
+
+    Returns one cluster_id per face, in the order of locations.
+    """
+    if not fe:
+        print("No face detected in image")
+        return []
+        
+    tolerance = 0.6
+    merge_candidates = encodings_manager.merge_candidates
+    # Match against faces other processes have added since the last read
+    encodings_manager.refresh()
+    image_name = Path(filepath).name
+    cluster_ids = []
+    
+    for location, encoding in zip(locations, fe):
+        # Clusters within tolerance, plus near misses just outside it
+        near = encodings_manager.find_near_clusters(encoding, tolerance + merge_candidates.margin)
+        curr_image_cluster_id, distance = min(near.items(), key=lambda item: item[1], default=(None, None))
+        
+        if curr_image_cluster_id and distance < tolerance:
+            print(f"Match found in cluster {curr_image_cluster_id} with distance {distance}")
+            curr_image_cluster_id = encodings_manager.add_encoding(curr_image_cluster_id, encoding, image_name, location)
+        else:
+            # Named when the face is stored, so concurrent writers get distinct ids
+            curr_image_cluster_id = encodings_manager.add_encoding(None, encoding, image_name, location)
+            print(f"Creating new cluster {curr_image_cluster_id}")
+        # A face close to more than one cluster is evidence they are the same person
+        merge_candidates.record(curr_image_cluster_id, near.items())
+        cluster_ids.append(curr_image_cluster_id)
+    
+    return cluster_ids
+
+def store_image(filepath, cluster_ids, content_hash=None, locations=None):
+    """Store the image once in the blob store and link it into its cluster directories.
+
+    Content that is already stored is not copied again; cluster membership
+    is a hard link to the blob (or a copy where links are not supported).
+    The catalog records the memberships and, given one location per cluster
+    id, the faces.
+    """
+    if isinstance(cluster_ids, str):
+        cluster_ids = [cluster_ids]
+    
+    blob = put_blob(filepath, content_hash, RESULTS_FOLDER)
+    first_path = None
+    for cluster_id in dict.fromkeys(cluster_ids):
+        # Use RESULTS_FOLDER instead of results_path
+        dest_path = Path(RESULTS_FOLDER) / cluster_id / Path(filepath).name
+        link_blob(blob, dest_path)
+        print(f"Linked {dest_path} to {blob.name}")
+        first_path = first_path or dest_path
+    
+    faces = zip(cluster_ids, locations) if locations is not None else ()
+    get_catalog().record_image(Path(filepath).name, blob.stem, blob.stat().st_size, cluster_ids, faces)
+    return first_path
@@ -0,0 +1,55 @@
+import multiprocessing
+import numpy as np
+from encodings_manager import EncodingsManager
+
+
+def test_append_after_merge_and_compaction(tmp_path):
+    manager = EncodingsManager(str(tmp_path), fsync=False)
+    rng = np.random.default_rng(0)
+    manager.add_encoding('cluster_1', rng.normal(size=128))
+    manager.add_encoding('cluster_2', rng.normal(size=128))
+    manager.identity.merge('cluster_2', 'cluster_1')
+    assert manager.save_encodings()
+
+    manager.add_encoding('cluster_3', rng.normal(size=128))
+    assert list(manager.labels) == [0, 0, 1]
+    assert manager.clusters == ['cluster_1', 'cluster_3']
+
+    reloaded = EncodingsManager(str(tmp_path))
+    assert list(reloaded.labels) == [0, 0, 1]
+    assert reloaded.clusters == ['cluster_1', 'cluster_3']
+
+
+def merge_and_compact(results_path, source, target):
+    manager = EncodingsManager(results_path, fsync=False)
+    manager.identity.merge(source, target)
+    assert manager.save_encodings()
+
+
+def run_in_process(target, *args):
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_new_cluster_ids_follow_merges_made_by_another_process(tmp_path):
+    results_path = str(tmp_path)
+    worker = EncodingsManager(results_path, fsync=False)
+    rng = np.random.default_rng(1)
+    for n in range(1, 10):
+        worker.add_encoding(f'cluster_{n}', rng.normal(size=128))
+
+    run_in_process(merge_and_compact, results_path, 'cluster_9', 'cluster_4')
+    cluster_id = worker.add_encoding(None, rng.normal(size=128))
+    assert cluster_id not in ('cluster_9', 'cluster_4')
+    assert worker.identity.find(cluster_id) == cluster_id
+    assert worker.identity.find('cluster_9') == 'cluster_4'
+
+    # A merge made here keeps the other process's merge
+    worker.identity.merge('cluster_8', 'cluster_1')
+    run_in_process(merge_and_compact, results_path, 'cluster_7', 'cluster_2')
+    worker.refresh()
+    assert worker.identity.find('cluster_9') == 'cluster_4'
+    assert worker.identity.find('cluster_8') == 'cluster_1'
+    assert worker.identity.find('cluster_7') == 'cluster_2'
@@ -0,0 +1,82 @@
+import os
+import multiprocessing
+import numpy as np
+import encodings_store
+from encodings_store import JOURNAL_FILE
+from encodings_manager import EncodingsManager
+
+
+def add_faces(results_path, count, seed):
+    manager = EncodingsManager(results_path, fsync=False)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        manager.add_encoding(f'cluster_{seed}', rng.normal(size=128), f'{seed}_{i}.jpg', (0, 1, 1, 0))
+
+
+def test_torn_journal_tail_is_ignored_and_trimmed(tmp_path):
+    add_faces(str(tmp_path), 3, 1)
+    journal = os.path.join(str(tmp_path), JOURNAL_FILE)
+    with open(journal, 'ab') as f:
+        # Record header promising more payload than was written
+        f.write(b'\xff\x00\x00\x00\x00\x00\x00\x00partial')
+
+    manager = EncodingsManager(str(tmp_path), fsync=False)
+    assert manager.labels.size == 3
+    manager.add_encoding('cluster_1', np.zeros(128))
+    assert EncodingsManager(str(tmp_path)).labels.size == 4
+
+
+def test_corrupt_record_stops_replay(tmp_path):
+    add_faces(str(tmp_path), 3, 1)
+    journal = os.path.join(str(tmp_path), JOURNAL_FILE)
+    with open(journal, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xff]))
+    assert EncodingsManager(str(tmp_path)).labels.size == 2
+
+
+def test_compaction_during_concurrent_append(tmp_path):
+    results_path = str(tmp_path)
+    manager = EncodingsManager(results_path, fsync=False)
+    writer = multiprocessing.get_context('spawn').Process(target=add_faces, args=(results_path, 200, 2))
+    writer.start()
+    rng = np.random.default_rng(3)
+    while writer.is_alive():
+        manager.add_encoding('cluster_3', rng.normal(size=128))
+        assert manager.save_encodings()
+    writer.join()
+    assert writer.exitcode == 0
+
+    added = int((np.asarray(manager.clusters)[manager.labels] == 'cluster_3').sum())
+    reloaded = EncodingsManager(results_path)
+    names = np.asarray(reloaded.clusters)[reloaded.labels]
+    assert (names == 'cluster_2').sum() == 200
+    assert (names == 'cluster_3').sum() == added
+
+
+def test_restart_after_interrupted_write_store(tmp_path, monkeypatch):
+    results_path = str(tmp_path)
+    add_faces(results_path, 50, 4)
+    manager = EncodingsManager(results_path, fsync=False)
+    assert manager.save_encodings()
+
+    replace_file = encodings_store._replace_file
+    calls = []
+
+    def crash_after_two_files(path, write):
+        calls.append(path)
+        if len(calls) > 2:
+            raise OSError("simulated crash")
+        replace_file(path, write)
+
+    manager.add_encoding('cluster_4', np.zeros(128))
+    monkeypatch.setattr(encodings_store, '_replace_file', crash_after_two_files)
+    assert not manager.save_encodings()
+    monkeypatch.setattr(encodings_store, '_replace_file', replace_file)
+
+    restarted = EncodingsManager(results_path, fsync=False)
+    assert restarted.labels.size == 51
+    assert restarted.save_encodings()
+    assert EncodingsManager(results_path).labels.size == 51
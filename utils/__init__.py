@@ -1,5 +1,5 @@
-from .google_drive import upload_images_to_drive, get_drive_service
-from .notifications import send_cluster_notification
+from .google_drive import upload_images_to_drive, get_drive_service, print_progress
+from .notifications import send_cluster_notification, start_notification_sender
 from .system import show_system_stats
 from .core import (
     delete_image_from_cluster,
@@ -15,6 +15,7 @@ from .core import (
 from pathlib import Path
 from shared_constants import RESULTS_FOLDER
 from stages.process_image import process_file
+from cluster_identity import get_cluster_identity
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -25,6 +26,7 @@ from PIL import Image
 
 __all__ = [
     'upload_to_drive_and_send_email',
+    'approve_requests_by_cluster',
     'show_cluster_preview',
     'process_uploaded_files',
     'delete_cluster',
@@ -36,10 +38,12 @@ __all__ = [
     'save_encodings',
     'email_is_valid',
     'send_cluster_notification',
+    'start_notification_sender',
     'show_system_stats'
 ]
 
-def upload_to_drive_and_send_email(to_email, cluster_id):
+def upload_cluster(cluster_id, progress=None):
+    """Sync the cluster's images to its Drive folder; returns (success, drive link or error message)"""
     try:
         cluster_path = Path(RESULTS_FOLDER) / str(cluster_id)
         print(f"Looking for images in: {cluster_path}")
@@ -52,43 +56,78 @@ def upload_to_drive_and_send_email(to_email, cluster_id):
         for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
             image_files.extend(list(cluster_path.glob(f'*{ext}')))
         
-        print(f"Found {len(image_files)} images: {[f.name for f in image_files]}")
+        print(f"Found {len(image_files)} images")
         
         if not image_files:
             raise Exception("No images found in cluster directory")
             
-        success, drive_link = upload_images_to_drive(
+        return upload_images_to_drive(
             cluster_id, 
-            image_files
+            image_files,
+            progress=progress or print_progress
         )
         
+    except Exception as e:
+        print(f"Error uploading cluster {cluster_id}: {str(e)}")
+        return False, str(e)
+
+def upload_to_drive_and_send_email(to_email, cluster_id, progress=None, request_id=None):
+    """Upload the cluster to Drive and queue the email with the link; progress(done, total, result) is called per file"""
+    try:
+        # Requests may name a cluster that has since been merged or renamed
+        cluster_id = get_cluster_identity(RESULTS_FOLDER).find(str(cluster_id))
+        success, drive_link = upload_cluster(cluster_id, progress)
+        
         if not success:
             raise Exception(f"Failed to upload to Drive: {drive_link}")
             
-        notif_success, notif_msg = send_email_notification(to_email, cluster_id, drive_link)
+        notif_success, notif_msg = send_cluster_notification(
+            to_email, cluster_id, drive_link, [request_id] if request_id else ()
+        )
         
         if not notif_success:
-            raise Exception(f"Failed to send notification: {notif_msg}")
+            raise Exception(notif_msg)
             
-        return True, "Successfully uploaded to Drive and sent email"
+        return True, "Successfully uploaded to Drive and queued email"
         
     except Exception as e:
         print(f"Error in upload_to_drive_and_send_email: {str(e)}")
         return False, str(e)
 
-def show_system_stats():
-    """Get system statistics for admin dashboard"""
-    stats = {
-        'cpu_percent': psutil.cpu_percent(),
-        'memory_percent': psutil.virtual_memory().percent,
-        'disk_usage': psutil.disk_usage('/').percent,
-        'clusters_count': len(list(Path(RESULTS_FOLDER).glob('cluster_*'))),
-        'total_images': sum(
-            len(list(Path(RESULTS_FOLDER).glob(f'cluster_*/*.{ext}')))
-            for ext in ['jpg', 'jpeg', 'png']
-        )
-    }
-    return stats
+def approve_requests_by_cluster(requests, progress=None):
+    """Deliver many requests with one upload per cluster.
+
+    Requests are grouped by their current cluster; each cluster is uploaded
+    once and every address that asked for it gets one queued email with the
+    link.
+    progress(done, total, cluster_id) is called after each cluster. Returns
+    (approved request ids, [(request_id, error message)] for the rest).
+    """
+    identity = get_cluster_identity(RESULTS_FOLDER)
+    groups = {}
+    for request in requests:
+        groups.setdefault(identity.find(str(request['cluster_id'])), []).append(request)
+    
+    approved, failures = [], []
+    for done, (cluster_id, group) in enumerate(groups.items(), 1):
+        print(f"Delivering {cluster_id} for {len(group)} requests ({done}/{len(groups)})")
+        success, drive_link = upload_cluster(cluster_id)
+        if not success:
+            failures.extend((request['request_id'], f"Failed to upload to Drive: {drive_link}") for request in group)
+        else:
+            request_ids_by_email = {}
+            for request in group:
+                request_ids_by_email.setdefault(request['email'], []).append(request['request_id'])
+            for email, request_ids in request_ids_by_email.items():
+                notif_success, notif_msg = send_cluster_notification(email, cluster_id, drive_link, request_ids)
+                if notif_success:
+                    approved.extend(request_ids)
+                else:
+                    failures.extend((request_id, notif_msg) for request_id in request_ids)
+        if progress:
+            progress(done, len(groups), cluster_id)
+    
+    return approved, failures
 
 def show_cluster_preview(cluster_id):
     cluster_path = Path(RESULTS_FOLDER) / str(cluster_id)
@@ -2,6 +2,11 @@ import os
 from pathlib import Path
 from PIL import Image
 from shared_constants import RESULTS_FOLDER
+from cluster_identity import get_cluster_identity
+from database import Database
+from blob_store import collect_garbage
+from catalog import get_catalog
+from encodings_store import stored_cluster_ids
 import shutil
 import pickle
 import re
@@ -11,6 +16,7 @@ def delete_image_from_cluster(cluster_id, image_name):
         image_path = Path(RESULTS_FOLDER) / str(cluster_id) / image_name
         if image_path.exists():
             image_path.unlink()
+        get_catalog().remove_image(str(cluster_id), image_name)
         return True
     except Exception as e:
         print(f"Error deleting image: {str(e)}")
@@ -24,6 +30,7 @@ def move_image_to_cluster(source_cluster, target_cluster, image_name):
         if source_path.exists():
             target_path.parent.mkdir(exist_ok=True)
             source_path.rename(target_path)
+            get_catalog().move_image(str(source_cluster), str(target_cluster), image_name)
         return True
     except Exception as e:
         print(f"Error moving image: {str(e)}")
@@ -68,25 +75,17 @@ def process_uploaded_files(files):
     return processed_files
 
 def get_all_clusters():
-    clusters = []
-    results_path = Path(RESULTS_FOLDER)
-    
-    if results_path.exists():
-        for cluster_dir in results_path.glob('cluster_*'):
-            if cluster_dir.is_dir():
-                image_count = len(list(cluster_dir.glob('*.{jpg,jpeg,png}')))
-                clusters.append({
-                    'id': cluster_dir.name,
-                    'image_count': image_count
-                })
-    
-    return clusters
+    """Clusters with their image and face counts, from the catalog"""
+    return get_catalog().list_clusters()
 
 def delete_cluster(cluster_id):
     try:
         cluster_path = Path(RESULTS_FOLDER) / str(cluster_id)
         if cluster_path.exists():
+            # Removes the cluster's links; images no other cluster uses go with them
             shutil.rmtree(cluster_path)
+            get_catalog().delete_cluster(str(cluster_id))
+            collect_garbage(RESULTS_FOLDER)
             return True, "Cluster deleted successfully"
         return False, "Cluster not found"
     except Exception as e:
@@ -118,8 +117,20 @@ def rename_cluster(cluster_id, new_name):
             
         if new_path.exists():
             return False, "New cluster name already exists"
-            
+        
+        # A cluster can exist without a folder; renaming onto it would merge two people
+        stored = stored_cluster_ids(RESULTS_FOLDER)
+        def exists(name):
+            return name in stored or get_catalog().has_cluster(name)
+        
         old_path.rename(new_path)
+        # Stored encodings and requests follow the new name
+        success, message = get_cluster_identity(RESULTS_FOLDER).rename(str(cluster_id), str(new_name), exists)
+        if not success:
+            new_path.rename(old_path)
+            return False, message
+        get_catalog().rename_cluster(str(cluster_id), str(new_name))
+        Database().reassign_cluster(str(cluster_id), str(new_name))
         return True, "Cluster renamed successfully"
     except Exception as e:
         print(f"Error renaming cluster: {str(e)}")
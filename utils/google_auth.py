@@ -0,0 +1,116 @@
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+from google.auth.credentials import AnonymousCredentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import os
+import json
+import queue
+import pickle
+import threading
+import httplib2
+
+SCOPES = [
+    'https://www.googleapis.com/auth/drive.file',
+    'https://www.googleapis.com/auth/gmail.send',
+    'https://www.googleapis.com/auth/gmail.compose'
+]
+TOKEN_PATH = Path('token.pickle')
+# Tokens this close to expiry are refreshed before a client is handed out
+REFRESH_MARGIN = timedelta(minutes=5)
+HTTP_TIMEOUT = 60
+
+_credentials = None
+_credentials_lock = threading.Lock()
+_documents = {}
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _save_token(creds):
+    tmp_path = TOKEN_PATH.with_name(f"{TOKEN_PATH.name}.tmp")
+    with open(tmp_path, 'wb') as token:
+        pickle.dump(creds, token)
+    os.replace(tmp_path, TOKEN_PATH)
+
+
+def _needs_refresh(creds):
+    if not creds.valid:
+        return True
+    # google-auth keeps expiry as naive UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry is not None and creds.expiry - now < REFRESH_MARGIN
+
+
+def get_credentials():
+    """Process-wide user credentials, read from token.pickle once and refreshed ahead of expiry"""
+    global _credentials
+    with _credentials_lock:
+        creds = _credentials
+        if creds is None and TOKEN_PATH.exists():
+            with open(TOKEN_PATH, 'rb') as token:
+                creds = pickle.load(token)
+
+        if not creds or _needs_refresh(creds):
+            if creds and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                credentials_path = Path(os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'credentials.json'))
+                if not credentials_path.exists():
+                    raise FileNotFoundError(
+                        "credentials.json not found. Please download it from Google Cloud Console "
+                        "and place it in the project root directory or set GOOGLE_APPLICATION_CREDENTIALS"
+                    )
+                flow = InstalledAppFlow.from_client_secrets_file(str(credentials_path), SCOPES)
+                creds = flow.run_local_server(port=0)
+            _save_token(creds)
+
+        _credentials = creds
+        return creds
+
+
+def _document(api, version, root_url):
+    """Parsed discovery document, optionally pointed at another server; parsed once per process"""
+    if (api, version) not in _documents:
+        _documents[(api, version)] = json.loads(get_static_doc(api, version))
+    document = _documents[(api, version)]
+    if root_url:
+        document = dict(document, rootUrl=root_url)
+    return document
+
+
+def new_service(api, version, root_url=None):
+    """A client for api built from the cached discovery document and credentials.
+
+    root_url sends the calls, unauthenticated, to another server.
+    """
+    credentials = AnonymousCredentials() if root_url else get_credentials()
+    http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    return build_from_document(_document(api, version, root_url), http=http)
+
+
+@contextmanager
+def client(api, version, root_url=None):
+    """Borrow a pooled client for api for the duration of a with block.
+
+    Clients keep their HTTP connections open between uses. They are not
+    thread safe, so each is lent to one thread at a time; the pool grows to
+    the number of threads using it at once.
+    """
+    if not root_url:
+        # Refreshes the credentials shared by every pooled client
+        get_credentials()
+    with _pools_lock:
+        pool = _pools.setdefault((api, version, root_url), queue.LifoQueue())
+    try:
+        service = pool.get_nowait()
+    except queue.Empty:
+        service = new_service(api, version, root_url)
+    try:
+        yield service
+    finally:
+        pool.put(service)
@@ -1,160 +1,269 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import os
 from dotenv import load_dotenv
-import pickle
-import socket
+import time
+import random
+import mimetypes
+import httplib2
+from database import Database
+from catalog import get_catalog
+from blob_store import hash_file
+from .google_auth import SCOPES, new_service, client
 
 load_dotenv()
 
 # Allow insecure localhost for testing
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
-SCOPES = [
-    'https://www.googleapis.com/auth/drive.file',
-    'https://www.googleapis.com/auth/gmail.send',
-    'https://www.googleapis.com/auth/gmail.compose'
-]
+UPLOAD_WORKERS = int(os.getenv('DRIVE_UPLOAD_WORKERS') or 8)
+UPLOAD_RETRIES = 5
+RETRY_BASE_SECONDS = 1.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Larger files are sent in a resumable session; smaller ones in one request
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
 
-def setup_google_drive():
-    creds = None
-    credentials_path = Path(os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'credentials.json'))
-    token_path = Path('token.pickle')
-    
-    if not credentials_path.exists():
-        raise FileNotFoundError(
-            "credentials.json not found. Please download it from Google Cloud Console "
-            "and place it in the project root directory or set GOOGLE_APPLICATION_CREDENTIALS"
-        )
-    
-    if token_path.exists():
-        with open(token_path, 'rb') as token:
-            creds = pickle.load(token)
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                str(credentials_path),
-                SCOPES
-            )
-            creds = flow.run_local_server(port=0)
-        
-        with open(token_path, 'wb') as token:
-            pickle.dump(creds, token)
-    
-    return creds
+def drive_endpoint():
+    """DRIVE_API_ENDPOINT (e.g. http://localhost:8080/) sends Drive calls, unauthenticated, to a fake Drive"""
+    return os.getenv('DRIVE_API_ENDPOINT') or None
 
 def get_drive_service():
     """Get an authorized Drive service instance"""
     try:
-        creds = setup_google_drive()
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        return new_service('drive', 'v3', drive_endpoint())
     except Exception as e:
         raise Exception(f"Drive service initialization failed: {str(e)}")
 
-def upload_images_to_drive(cluster_id, image_paths):
-    """Upload cluster images to Google Drive and return sharing link"""
+def drive_client():
+    """Borrow a pooled Drive client for a with block"""
+    return client('drive', 'v3', drive_endpoint())
+
+def is_retryable(error):
+    """Rate limits, server errors and dropped connections are worth another try"""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status in RETRYABLE_STATUSES or (status == 403 and b'RateLimitExceeded' in (error.content or b''))
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+def upload_file(service, folder_id, image_path, retries=UPLOAD_RETRIES, backoff=RETRY_BASE_SECONDS,
+                file_id=None):
+    """Upload one file into folder_id and return a result dict for it.
+
+    429/5xx responses and connection errors are retried with exponential
+    backoff and jitter. Files over RESUMABLE_THRESHOLD use a resumable
+    session, so a retry continues from the last chunk Drive acknowledged;
+    smaller files go up in a single request. With file_id the existing
+    Drive file gets the new contents instead.
+    """
+    image_path = Path(image_path)
+    result = {'name': image_path.name, 'ok': False, 'file_id': None, 'bytes': 0,
+              'seconds': 0.0, 'attempts': 0, 'error': None}
+    start = time.perf_counter()
+    media = None
     try:
-        service = get_drive_service()
-        
-        # Debug print folder ID
-        folder_parent_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
-        print(f"Using Drive folder ID: {folder_parent_id}")
-        
-        if not folder_parent_id:
-            raise ValueError("GOOGLE_DRIVE_FOLDER_ID not set in environment")
-            
-        # Debug print image paths
-        print(f"\nAttempting to upload {len(image_paths)} images:")
-        for path in image_paths:
-            print(f"- {path} (exists: {Path(path).exists()})")
+        result['bytes'] = image_path.stat().st_size
+        mime_type = mimetypes.guess_type(image_path.name)[0] or 'image/jpeg'
+        media = MediaFileUpload(str(image_path), mimetype=mime_type,
+                                resumable=result['bytes'] > RESUMABLE_THRESHOLD)
         
-        # Get folder ID from env
-        folder_parent_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
-        if not folder_parent_id:
-            raise ValueError("GOOGLE_DRIVE_FOLDER_ID not set in environment")
-            
-        # Create cluster folder
-        folder_metadata = {
-            'name': f'Face_Cluster_{cluster_id}',
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [folder_parent_id]
-        }
-        
-        folder = service.files().create(
-            body=folder_metadata,
-            fields='id, webViewLink'
-        ).execute()
-        
-        folder_id = folder.get('id')
-        folder_link = folder.get('webViewLink')
+        def new_request(file_id):
+            if file_id:
+                return service.files().update(fileId=file_id, media_body=media, fields='id')
+            return service.files().create(
+                body={'name': image_path.name, 'parents': [folder_id]},
+                media_body=media,
+                fields='id'
+            )
         
-        if not folder_id:
-            raise Exception("Failed to get folder ID")
-            
-        # Upload images
-        uploaded_count = 0
-        for image_path in image_paths:
+        request = new_request(file_id)
+        while True:
+            result['attempts'] += 1
             try:
-                if not isinstance(image_path, Path):
-                    image_path = Path(image_path)
-                    
-                if not image_path.exists():
-                    print(f"Skipping non-existent image: {image_path}")
-                    continue
-                    
-                mime_type = 'image/jpeg'
-                if image_path.suffix.lower() in ['.png']:
-                    mime_type = 'image/png'
-                
-                file_metadata = {
-                    'name': image_path.name,
-                    'parents': [folder_id]
-                }
-                
-                media = MediaFileUpload(
-                    str(image_path),
-                    mimetype=mime_type,
-                    resumable=True
-                )
-                
-                file = service.files().create(
-                    body=file_metadata,
-                    media_body=media,
-                    fields='id'
-                ).execute()
-                
-                uploaded_count += 1
-                print(f"Uploaded {image_path.name} to Drive ({uploaded_count}/{len(image_paths)})")
-                
+                if media.resumable():
+                    response = None
+                    while response is None:
+                        _, response = request.next_chunk()
+                else:
+                    response = request.execute()
+                result['ok'] = True
+                result['file_id'] = response.get('id')
+                break
             except Exception as e:
-                print(f"Error uploading {image_path}: {str(e)}")
-                continue
-        
-        if uploaded_count == 0:
-            raise Exception("No images were uploaded successfully")
-            
-        # Set folder permissions for sharing
-        permission = {
-            'type': 'anyone',
-            'role': 'reader',
-            'allowFileDiscovery': False
-        }
-        
-        service.permissions().create(
-            fileId=folder_id,
-            body=permission
-        ).execute()
-        
-        return True, folder_link
-        
+                if file_id and isinstance(e, HttpError) and e.resp.status == 404:
+                    # Deleted from Drive by hand; upload it again
+                    file_id = None
+                    request = new_request(None)
+                    continue
+                if result['attempts'] > retries or not is_retryable(e):
+                    raise
+                time.sleep(backoff * 2 ** (result['attempts'] - 1) * random.uniform(0.5, 1.5))
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        if media is not None:
+            media.stream().close()
+        result['seconds'] = time.perf_counter() - start
+    return result
+
+def upload_files(folder_id, image_paths, workers=UPLOAD_WORKERS, progress=None, file_ids=None):
+    """Upload image_paths into folder_id from a pool of `workers` threads.
+
+    Each upload borrows its own pooled Drive client, since clients are not
+    thread safe. file_ids maps names already in the folder to their Drive file,
+    which is updated in place. progress(done, total, result) is called as
+    each file finishes. Returns a report with per-file results, failures and
+    throughput.
+    """
+    file_ids = file_ids or {}
+    def upload(path):
+        with drive_client() as service:
+            return upload_file(service, folder_id, path, file_id=file_ids.get(Path(path).name))
+
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(upload, path) for path in image_paths]
+        for future in as_completed(futures):
+            results.append(future.result())
+            if progress:
+                progress(len(results), len(futures), results[-1])
+
+    seconds = time.perf_counter() - start
+    uploaded = [r for r in results if r['ok']]
+    total_bytes = sum(r['bytes'] for r in uploaded)
+    return {
+        'uploaded': len(uploaded),
+        'failed': [r for r in results if not r['ok']],
+        'results': results,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'files_per_second': len(uploaded) / seconds if seconds else 0.0,
+        'mb_per_second': total_bytes / (1024 * 1024) / seconds if seconds else 0.0
+    }
+
+def print_progress(done, total, result):
+    if result['ok']:
+        print(f"Uploaded {result['name']} to Drive ({done}/{total}, {result['seconds']:.1f}s, "
+              f"{result['attempts']} attempt(s))")
+    else:
+        print(f"Error uploading {result['name']} ({done}/{total}): {result['error']}")
+
+def content_hashes(cluster_id, image_paths):
+    """{name: SHA-256} for image_paths, from the catalog where it has them"""
+    catalogued = get_catalog().image_hashes(cluster_id)
+    return {
+        Path(path).name: catalogued.get(Path(path).name) or hash_file(path)
+        for path in image_paths
+        if Path(path).exists()
+    }
+
+def get_cluster_folder(service, db, cluster_id, folder_parent_id):
+    """The cluster's Drive folder as (folder_id, folder_link, created).
+
+    The folder from an earlier approval is reused while it still exists in
+    Drive; otherwise a new shared folder is created and recorded.
+    """
+    saved = db.get_drive_folder(cluster_id)
+    if saved:
+        try:
+            folder = service.files().get(
+                fileId=saved['folder_id'],
+                fields='id, trashed'
+            ).execute(num_retries=UPLOAD_RETRIES)
+            if not folder.get('trashed'):
+                return saved['folder_id'], saved['folder_link'], False
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+        print(f"Drive folder of {cluster_id} is gone, creating a new one")
+    
+    folder_metadata = {
+        'name': f'Face_Cluster_{cluster_id}',
+        'mimeType': 'application/vnd.google-apps.folder',
+        'parents': [folder_parent_id]
+    }
+    folder = service.files().create(
+        body=folder_metadata,
+        fields='id, webViewLink'
+    ).execute(num_retries=UPLOAD_RETRIES)
+    
+    if not folder.get('id'):
+        raise Exception("Failed to get folder ID")
+    
+    # Set folder permissions for sharing
+    permission = {
+        'type': 'anyone',
+        'role': 'reader',
+        'allowFileDiscovery': False
+    }
+    service.permissions().create(
+        fileId=folder['id'],
+        body=permission
+    ).execute(num_retries=UPLOAD_RETRIES)
+    
+    db.save_drive_folder(cluster_id, folder['id'], folder.get('webViewLink'))
+    return folder['id'], folder.get('webViewLink'), True
+
+def upload_images_to_drive(cluster_id, image_paths, workers=UPLOAD_WORKERS, progress=print_progress):
+    """Sync cluster images to the cluster's Drive folder and return sharing link.
+
+    Only images that are new or whose content changed since the last sync
+    are uploaded; images no longer in the cluster are removed from Drive.
+    """
+    try:
+        with drive_client() as service:
+            return sync_cluster_folder(service, Database(), cluster_id, image_paths, workers, progress)
     except Exception as e:
         print(f"Drive upload error: {str(e)}")
         return False, str(e)
+
+def sync_cluster_folder(service, db, cluster_id, image_paths, workers, progress):
+    """Bring the cluster's Drive folder in line with image_paths; returns (True, folder link)"""
+    folder_parent_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
+    print(f"Using Drive folder ID: {folder_parent_id}")
+    if not folder_parent_id:
+        raise ValueError("GOOGLE_DRIVE_FOLDER_ID not set in environment")
+    
+    folder_id, folder_link, created = get_cluster_folder(service, db, str(cluster_id), folder_parent_id)
+    print(f"{'Created' if created else 'Reusing'} Drive folder {folder_id} for {cluster_id}")
+    
+    hashes = content_hashes(str(cluster_id), image_paths)
+    synced = db.get_drive_files(str(cluster_id))
+    changed = [
+        path for path in image_paths
+        if Path(path).name not in synced or synced[Path(path).name]['content_hash'] != hashes.get(Path(path).name)
+    ]
+    stale = [name for name in synced if name not in hashes]
+    print(f"\n{len(image_paths) - len(changed)} images already in Drive, uploading {len(changed)} "
+          f"with {workers} workers")
+    
+    report = upload_files(folder_id, changed, workers, progress,
+                          file_ids={name: row['file_id'] for name, row in synced.items()})
+    print(f"Uploaded {report['uploaded']}/{len(changed)} images in {report['seconds']:.1f}s "
+          f"({report['files_per_second']:.1f} files/s, {report['mb_per_second']:.2f} MB/s)")
+    for failure in report['failed']:
+        print(f"Failed: {failure['name']} after {failure['attempts']} attempt(s): {failure['error']}")
+    
+    removed = []
+    for name in stale:
+        try:
+            service.files().delete(fileId=synced[name]['file_id']).execute(num_retries=UPLOAD_RETRIES)
+            removed.append(name)
+        except HttpError as e:
+            if e.resp.status == 404:
+                removed.append(name)
+            else:
+                print(f"Error removing {name} from Drive: {str(e)}")
+    
+    db.save_drive_sync(
+        str(cluster_id),
+        [(r['name'], hashes[r['name']], r['file_id']) for r in report['results'] if r['ok']],
+        removed
+    )
+    
+    if not db.get_drive_files(str(cluster_id)):
+        raise Exception("No images were uploaded successfully")
+    
+    return True, folder_link
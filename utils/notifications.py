@@ -2,64 +2,209 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
-from pathlib import Path
+import time
+import threading
+from database import Database
+
+SEND_BATCH = 20
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+POLL_SECONDS = 2.0
+# Sessions idle longer than this are checked with NOOP before reuse
+IDLE_CHECK_SECONDS = 30
+
+def smtp_settings():
+    """SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD and USE_TLS from the environment.
+
+    Without a username no login is attempted, so a local debugging server
+    (e.g. `python -m aiosmtpd -n -l localhost:1025` with USE_TLS=False) works.
+    """
+    return {
+        'server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+        'port': int(os.getenv('SMTP_PORT', '587')),
+        'username': os.getenv('SMTP_USERNAME'),
+        'password': os.getenv('SMTP_PASSWORD'),
+        'use_tls': os.getenv('USE_TLS', 'True').lower() not in ('false', '0', 'no'),
+        'from_email': os.getenv('FROM_EMAIL') or os.getenv('SMTP_USERNAME') or 'noreply@localhost'
+    }
 
 def verify_smtp_credentials():
     try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_username = os.getenv('SMTP_USERNAME')
-        smtp_password = os.getenv('SMTP_PASSWORD')
-        
-        if not all([smtp_username, smtp_password]):
+        settings = smtp_settings()
+        if not all([settings['username'], settings['password']]):
             return False, "SMTP credentials not configured"
-            
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.ehlo()
-            server.starttls()
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            return True, "SMTP credentials verified"
+
+        session = SMTPSession(settings)
+        session.connection()
+        session.close()
+        return True, "SMTP credentials verified"
     except smtplib.SMTPAuthenticationError:
         return False, "Invalid SMTP credentials. Please check your App Password"
     except Exception as e:
         return False, f"SMTP connection error: {str(e)}"
 
-def send_cluster_notification(to_email, cluster_id, drive_link):
-    """Send email notification about cluster upload"""
-    # First verify credentials
-    success, message = verify_smtp_credentials()
-    if not success:
-        return False, f"SMTP verification failed: {message}"
-        
+def is_transient(error):
+    """Connection problems and 4xx replies may succeed later; 5xx replies will not"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+class SMTPSession:
+    """One authenticated SMTP connection, opened on first use and kept for later messages.
+
+    The connection is checked with NOOP after being idle and reopened when
+    the server has dropped it, so a batch pays for TLS and login once.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings or smtp_settings()
+        self._server = None
+        self._last_used = 0.0
+
+    def connection(self):
+        if self._server is not None and time.time() - self._last_used > IDLE_CHECK_SECONDS:
+            try:
+                if self._server.noop()[0] != 250:
+                    self.close()
+            except smtplib.SMTPException:
+                self.close()
+        if self._server is None:
+            server = smtplib.SMTP(self.settings['server'], self.settings['port'], timeout=30)
+            try:
+                server.ehlo()
+                if self.settings['use_tls']:
+                    server.starttls()
+                    server.ehlo()
+                if self.settings['username']:
+                    server.login(self.settings['username'], self.settings['password'])
+            except Exception:
+                server.close()
+                raise
+            self._server = server
+        self._last_used = time.time()
+        return self._server
+
+    def send(self, message):
+        try:
+            self.connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Dropped between messages; one fresh connection before giving up
+            self.close()
+            self.connection().send_message(message)
+        self._last_used = time.time()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+def build_message(from_email, row):
+    msg = MIMEMultipart()
+    msg['From'] = from_email
+    msg['To'] = row['to_email']
+    msg['Subject'] = row['subject']
+    msg.attach(MIMEText(row['body'], 'plain'))
+    return msg
+
+def retry_delay(attempts):
+    """Seconds before the next attempt, doubling from RETRY_BASE_SECONDS; None once attempts are used up"""
+    if attempts >= MAX_ATTEMPTS:
+        return None
+    return min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+
+def send_batch(db, session, limit=SEND_BATCH):
+    """Send up to limit due emails from the outbox over session; returns how many were claimed"""
+    rows = db.claim_notifications(limit)
+    sent = []
+    for row in rows:
+        try:
+            session.send(build_message(session.settings['from_email'], row))
+            sent.append(row['message_id'])
+        except Exception as e:
+            delay = retry_delay(row['attempts']) if is_transient(e) else None
+            print(f"Error sending email {row['message_id']} to {row['to_email']}: {str(e)}"
+                  f"{'' if delay is None else f', retrying in {delay}s'}")
+            db.retry_notification(row['message_id'], str(e), delay)
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                session.close()
+    db.mark_notifications_sent(sent)
+    return len(rows)
+
+def drain_outbox(db=None, session=None):
+    """Send every email that is due now; returns the number of send attempts"""
+    db = db or Database()
+    session = session or SMTPSession()
+    attempted = 0
     try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_username = os.getenv('SMTP_USERNAME')
-        smtp_password = os.getenv('SMTP_PASSWORD')
+        while True:
+            claimed = send_batch(db, session)
+            attempted += claimed
+            if not claimed:
+                return attempted
+    finally:
+        session.close()
+
+class NotificationSender(threading.Thread):
+    """Background thread that keeps the outbox drained over one reused SMTP session"""
+
+    def __init__(self, poll_seconds=POLL_SECONDS):
+        super().__init__(daemon=True)
+        self.poll_seconds = poll_seconds
+        self.wake = threading.Event()
+
+    def run(self):
+        db = Database()
+        session = SMTPSession()
+        requeued = db.requeue_notifications()
+        if requeued:
+            print(f"Requeued {requeued} interrupted emails")
+        while True:
+            try:
+                if send_batch(db, session):
+                    continue
+            except Exception as e:
+                print(f"Error in notification sender: {str(e)}")
+                session.close()
+            self.wake.wait(self.poll_seconds)
+            self.wake.clear()
+
+_sender = None
+_sender_lock = threading.Lock()
+
+def start_notification_sender():
+    """Start the process-wide sender thread unless it is already running"""
+    global _sender
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = NotificationSender()
+            _sender.start()
+        return _sender
 
-        msg = MIMEMultipart()
-        msg['From'] = smtp_username
-        msg['To'] = to_email
-        msg['Subject'] = f'Face Cluster {cluster_id} Images'
+def send_cluster_notification(to_email, cluster_id, drive_link, request_ids=()):
+    """Queue the email telling to_email where the cluster's images are.
 
+    The background sender delivers it and retries transient failures; its
+    delivery status is kept in the outbox for each of request_ids.
+    """
+    try:
         body = f"""
         Your face cluster images are ready!
-        
+
         Cluster ID: {cluster_id}
         View images here: {drive_link}
         """
-        msg.attach(MIMEText(body, 'plain'))
-
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.ehlo()
-            server.starttls()
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
-
-        return True, "Notification sent successfully"
-    except smtplib.SMTPAuthenticationError:
-        return False, "Gmail login failed. Please check your App Password"
+        Database().queue_notification(to_email, f'Face Cluster {cluster_id} Images', body, request_ids)
+        start_notification_sender().wake.set()
+        return True, "Notification queued"
     except Exception as e:
-        return False, f"Failed to send notification: {str(e)}"
\ No newline at end of file
+        return False, f"Failed to queue notification: {str(e)}"
+
+if __name__ == "__main__":
+    # python -m utils.notifications: send everything that is due and exit
+    print(f"Attempted {drain_outbox()} emails")
@@ -1,18 +1,18 @@
 import psutil
-import os
-from pathlib import Path
-from shared_constants import RESULTS_FOLDER
+from catalog import get_catalog
 
 def show_system_stats():
     """Get system statistics for admin dashboard"""
+    catalog_stats = get_catalog().stats()
     stats = {
         'cpu_percent': psutil.cpu_percent(),
         'memory_percent': psutil.virtual_memory().percent,
         'disk_usage': psutil.disk_usage('/').percent,
-        'clusters_count': len(list(Path(RESULTS_FOLDER).glob('cluster_*'))),
-        'total_images': sum(
-            len(list(Path(RESULTS_FOLDER).glob(f'cluster_*/*.{ext}')))
-            for ext in ['jpg', 'jpeg', 'png']
-        )
+        'clusters_count': catalog_stats['clusters'],
+        'total_clusters': catalog_stats['clusters'],
+        'total_images': catalog_stats['images'],
+        'unique_images': catalog_stats['unique_images'],
+        'total_faces': catalog_stats['faces'],
+        'storage_used': catalog_stats['stored_bytes'] / (1024 * 1024)
     }
     return stats
\ No newline at end of file
@@ -0,0 +1,160 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from shared_constants import RESULTS_FOLDER, MAX_DETECTION_SIDE
+from database import Database
+from encodings_manager import EncodingsManager
+from stages.process_image import encode_file, assign_encodings
+
+POLL_SECONDS = 1.0
+
+
+def handle_result(db, encodings_manager, job, result):
+    """Assign the faces of an encoded upload and record the outcome of its job"""
+    _, locations, fe, error = result
+    try:
+        if error:
+            db.fail_job(job['job_id'], error)
+            return
+        cluster_id = assign_encodings(job['image_path'], locations, fe, encodings_manager) if fe else None
+        if cluster_id:
+            db.complete_job(job, cluster_id)
+            print(f"Job {job['job_id']} matched cluster {cluster_id}")
+        else:
+            db.fail_job(job['job_id'], "No face detected")
+            print(f"Job {job['job_id']}: no face detected")
+    except Exception as e:
+        print(f"Error finishing job {job['job_id']}: {str(e)}")
+        db.fail_job(job['job_id'], str(e))
+    finally:
+        remove_upload(job)
+
+
+def remove_upload(job):
+    if os.path.exists(job['image_path']):
+        os.remove(job['image_path'])
+
+
+def retry_job(db, job, error):
+    """Queue a job again after its encoder process died, or fail it once out of attempts"""
+    if db.retry_job(job, error):
+        print(f"Job {job['job_id']} requeued after its encoder process died")
+    else:
+        print(f"Job {job['job_id']} failed: its encoder process died on every attempt")
+        remove_upload(job)
+
+
+def settle(db, encodings_manager, future, job):
+    """Record the outcome of a finished encode; returns False if the pool died under it"""
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        # Which job killed the encoder is unknown, so each one gets another try
+        retry_job(db, job, str(error))
+        return False
+    result = future.result() if error is None else (None, None, None, str(error))
+    handle_result(db, encodings_manager, job, result)
+    return True
+
+
+def start_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def restart_pool(db, encodings_manager, executor, in_flight, workers):
+    """Settle every job of a broken pool and return a fresh one"""
+    # A broken pool resolves all its futures, so this does not block for long
+    wait(in_flight)
+    for future, job in in_flight.items():
+        settle(db, encodings_manager, future, job)
+    in_flight.clear()
+    executor.shutdown(wait=False)
+    print("An encoder process died; restarted the pool")
+    return start_pool(workers)
+
+
+def run_worker(workers=2, poll_seconds=POLL_SECONDS, max_detection_side=MAX_DETECTION_SIDE, once=False):
+    """Process queued uploads until stopped (or until the queue is empty with once=True).
+
+    Detection and encoding run in a pool of `workers` processes. Cluster
+    assignment stays in this process. The admin page and main.py write the
+    same encodings store; every write takes the store lock and first picks
+    up the others' faces, so new cluster ids never collide. Run a single
+    worker process and scale it with `workers`. When an encoder process
+    dies the pool is restarted and its jobs are retried one at a time; a
+    job is failed once it has been claimed MAX_JOB_ATTEMPTS times.
+    """
+    db = Database()
+    requeued, failed = db.requeue_jobs()
+    if requeued:
+        print(f"Requeued {requeued} interrupted jobs")
+    for job in failed:
+        print(f"Job {job['job_id']} failed after {job['attempts']} interrupted attempts")
+        remove_upload(job)
+    encodings_manager = EncodingsManager(RESULTS_FOLDER)
+    in_flight = {}
+
+    executor = start_pool(workers)
+    try:
+        while True:
+            # Keep each encoder busy with one job and one waiting. Jobs that
+            # were in a pool when it died run alone, so only the one that
+            # kills it uses up its attempts
+            if any(job['attempts'] > 1 for job in in_flight.values()):
+                free = 0
+            elif db.has_retries():
+                free = 0 if in_flight else 1
+            else:
+                free = workers * 2 - len(in_flight)
+            if free > 0:
+                jobs = db.claim_jobs(free)
+                for n, job in enumerate(jobs):
+                    try:
+                        future = executor.submit(encode_file, job['image_path'], None, max_detection_side)
+                    except BrokenProcessPool as e:
+                        for unsent in jobs[n:]:
+                            retry_job(db, unsent, str(e))
+                        executor = restart_pool(db, encodings_manager, executor, in_flight, workers)
+                        break
+                    in_flight[future] = job
+
+            if not in_flight:
+                if once and not db.has_retries():
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            done, _ = wait(in_flight, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                if not settle(db, encodings_manager, future, in_flight.pop(future)):
+                    broken = True
+            if broken:
+                # The other jobs of the dead pool are requeued, not left to crash-loop
+                executor = restart_pool(db, encodings_manager, executor, in_flight, workers)
+    except KeyboardInterrupt:
+        print("Stopping worker")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        encodings_manager.close()
+    # Jobs still in flight were not recorded; they are requeued on the next start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match queued photo submissions to clusters")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Processes used for face detection and encoding")
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS,
+                        help="How often to check for new jobs when idle")
+    parser.add_argument('--max-detection-side', type=int, default=MAX_DETECTION_SIDE,
+                        help="Longest side, in pixels, of the copy faces are detected on (0 = full resolution)")
+    parser.add_argument('--once', action='store_true',
+                        help="Exit once the queue is empty")
+    args = parser.parse_args()
+    run_worker(max(1, args.workers), args.poll_seconds, args.max_detection_side, args.once)
+
+
+if __name__ == "__main__":
+    main()